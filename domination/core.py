@@ -25,6 +25,8 @@ import traceback
 import bisect
 import hashlib
 import logging
+import inspect
+import threading
 from pprint import pprint
 import cPickle as pickle
 try:
@@ -62,9 +64,18 @@ ENDGAME_NONE   = 0 #: End game when time expires
 ENDGAME_SCORE  = 1 #: End game when either team has 0 score
 ENDGAME_CRUMBS = 2 #: End game when all crumbs are picked up
 
+PHYSICS_PYTHON = 0 #: Solve collisions object by object (default)
+PHYSICS_NUMPY  = 1 #: Solve collisions with vectorized passes over arrays, requires numpy
+
+OBSERVATION_LISTS  = 0 #: Observations contain lists and tuples (default)
+OBSERVATION_ARRAYS = 1 #: Observations also contain numpy arrays, see :mod:`domination.tensors`
+
 DEFAULT_AGENT_FILE = os.path.join(os.path.dirname(__file__), 'agent.py')
 ILLEGAL_PATH_CHARS = r'[:*?"<>\|\n]+'
 
+LOG_ENGINE  = 'engine' #: Game log source of the output of the game itself
+LOG_SOURCES = {TEAM_RED: 'red', TEAM_BLUE: 'blue'} #: Game log sources of agent output
+
 AGENT_GLOBALS = globals().copy()
 
 ### CLASSES ###
@@ -83,8 +94,11 @@ class Settings(object):
                        spawn_time=10,
                        tilesize=16,
                        think_time=0.010,
+                       async_timeout=1.0,
                        capture_mode=CAPTURE_MODE_MAJORITY,
-                       end_condition=ENDGAME_SCORE):
+                       end_condition=ENDGAME_SCORE,
+                       physics=PHYSICS_PYTHON,
+                       observation=OBSERVATION_LISTS):
         """ Constructor for Settings class
         
             :param max_steps:     How long the game will last at most
@@ -99,9 +113,12 @@ class Settings(object):
             :param agent_type:    Type of the agents ('tank' or 'vacubot')
             :param spawn_time:    Time that it takes for tanks to respawn
             :param think_time:    How long the tanks have to do their computations (in seconds)
+            :param async_timeout: How long tanks can wait for actions from ``action_async`` (in seconds)
             :param capture_mode:  One of the CAPTURE_MODE constants.
             :param end_condition: One of the ENDGAME flags. Use bitwise OR for multiple.
             :param tilesize:      How big a single tile is (game units), change at risk of massive bugginess
+            :param physics:       One of the PHYSICS constants.
+            :param observation:   One of the OBSERVATION constants.
         """            
         self.max_steps     = max_steps    
         self.max_score     = max_score    
@@ -115,9 +132,12 @@ class Settings(object):
         self.agent_type    = agent_type   
         self.spawn_time    = spawn_time   
         self.think_time    = think_time   
+        self.async_timeout = async_timeout
         self.capture_mode  = capture_mode 
         self.end_condition = end_condition
         self.tilesize      = tilesize     
+        self.physics       = physics
+        self.observation   = observation
         # Validate
         if max_score % 2 != 0:
             raise Exception("Max score (%d) has to be even."%max_score)
@@ -147,30 +167,171 @@ class GameStats(object):
         return "== GAME STATS ==\n" + "\n".join(('%s : %r'%(k.ljust(maxlen), v)) for (k,v) in items)
         
 class GameLog(object):
-    """ Simple writable object that can replace
-        sys.stdout
+    """ Writable object that can replace sys.stdout. It keeps only
+        the most recent output, up to ``max_kbs``, and remembers which
+        source (``'engine'``, ``'red'`` or ``'blue'``) wrote each part.
     """
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, max_kbs=256, rate_kbs=None, spill=None):
+        """ Constructor for GameLog
+        
+            :param verbose:  Also print everything to the real stdout.
+            :param max_kbs:  How much output to keep, older output is dropped.
+            :param rate_kbs: How much each agent may print per step, the rest
+                               of its output is dropped. None for no limit.
+            :param spill:    A path or file, dropped output is written there instead.
+        """
         self.verbose = verbose
-        self.log = []
+        self.max_bytes = max_kbs * 1024
+        self.rate_bytes = None if rate_kbs is None else rate_kbs * 1024
+        self.spill = spill
+        self.entries = collections.deque() #: (source, string) tuples, oldest first
+        self.size = 0
+        self.dropped = 0 #: Number of bytes that were dropped (or spilled)
+        self.written = {} # Bytes written by each source in this step
+        self._spill_file = None
+        self._closed = False
+        # Only the game sets this, agents could otherwise pass as the engine
+        self._source = LOG_ENGINE
+        
+    @property
+    def source(self):
+        """ The source that subsequent writes are tagged with. """
+        return self._source
         
     def write(self, string):
+        source = self._source
+        if self.rate_bytes is not None and source != LOG_ENGINE:
+            written = self.written.get(source, 0) + len(string)
+            self.written[source] = written
+            if written > self.rate_bytes:
+                # Only say so the first time in a step
+                if written - len(string) <= self.rate_bytes:
+                    self._append(LOG_ENGINE, "\n== %s OUTPUT LIMITED TO %gKB PER STEP ==\n"%
+                                 (source.upper(), self.rate_bytes / 1024.0))
+                return
         if self.verbose and string != '\n':
             try:
                 print >> sys.__stdout__, string
             except:
                 pass
-        self.log.append(string)
+        self._append(source, string)
+        
+    def _append(self, source, string):
+        if len(string) > self.max_bytes:
+            self._drop(string[:-self.max_bytes])
+            string = string[-self.max_bytes:]
+        self.entries.append((source, string))
+        self.size += len(string)
+        while self.size > self.max_bytes:
+            _, old = self.entries.popleft()
+            self.size -= len(old)
+            self._drop(old)
+            
+    def _drop(self, string):
+        self.dropped += len(string)
+        if self.spill is not None and not self._closed:
+            if self._spill_file is None:
+                if isinstance(self.spill, basestring):
+                    self._spill_file = open(self.spill, 'a')
+                else:
+                    self._spill_file = self.spill
+            self._spill_file.write(string)
+            
+    def step(self):
+        """ Resets the rate limits, called on every step. """
+        self.written.clear()
+        
+    def flush(self):
+        if self._spill_file is not None:
+            self._spill_file.flush()
+        
+    def close(self):
+        """ Closes the spill file, if it was opened by the log. Output
+            that is dropped after this is counted, but not spilled.
+        """
+        if self._spill_file is not None and self._spill_file is not self.spill:
+            self._spill_file.close()
+        self._spill_file = None
+        self._closed = True
+        
+    def text(self, source=None):
+        """ Returns the kept output, or only the output of the given source. """
+        return ''.join(s for (src, s) in self.entries if source is None or src == source)
     
     def truncated(self, kbs=16):
+        """ Returns the log as a string of at most kbs KB, keeping the end. """
         s = str(self)
         if len(s) > kbs*1024:
-            msg = "\n== LOG TRUNCATED TO %dKB ==\n"%(kbs,)
-            s = s[:kbs*1024-len(msg)] + msg
+            msg = "== LOG TRUNCATED TO %dKB ==\n"%(kbs,)
+            s = msg + s[-(kbs*1024-len(msg)):]
         return s
         
     def __str__(self):
-        return ''.join(self.log)
+        if self.dropped:
+            return "== %dKB OF EARLIER OUTPUT DROPPED ==\n"%(self.dropped // 1024,) + self.text()
+        return self.text()
+        
+class StdoutRouter(object):
+    """ Replaces sys.stdout while any game is running, and writes
+        what is printed in each thread to the log of the game that is
+        running in that thread, or to the original stdout otherwise. 
+        That way, games can run in multiple threads without mixing 
+        their logs. There is a single instance, ``STDOUT_ROUTER``, see
+        :func:`_capture_stdout`. Agents see it as sys.stdout, so it 
+        doesn't hold on to the logs itself.
+    """
+    def write(self, string):
+        _stdout_target().write(string)
+        
+    def flush(self):
+        _stdout_target().flush()
+        
+    def __getattr__(self, name):
+        # Only the original stdout, agents shouldn't get at the game log
+        return getattr(_stdout_original, name)
+
+STDOUT_ROUTER = StdoutRouter()
+
+# Where STDOUT_ROUTER sends the output, only used by the functions below
+_stdout_local = threading.local()
+_stdout_lock = threading.Lock()
+_stdout_original = sys.stdout
+_stdout_users = 0
+
+def _stdout_target():
+    log = getattr(_stdout_local, 'log', None)
+    return _stdout_original if log is None else log
+
+def _capture_stdout(log):
+    """ Sends the output of the current thread to log, and returns
+        where it went before, to pass to :func:`_release_stdout`.
+    """
+    global _stdout_original, _stdout_users
+    with _stdout_lock:
+        # Also install again if someone else replaced sys.stdout
+        if sys.stdout is not STDOUT_ROUTER:
+            _stdout_original = sys.stdout
+            sys.stdout = STDOUT_ROUTER
+        _stdout_users += 1
+    previous = getattr(_stdout_local, 'log', None)
+    _stdout_local.log = log
+    return previous
+
+def _release_stdout(previous):
+    """ Undoes :func:`_capture_stdout`, and puts back the original 
+        sys.stdout when no game is capturing output anymore.
+    """
+    global _stdout_users
+    _stdout_local.log = previous
+    with _stdout_lock:
+        _stdout_users -= 1
+        if _stdout_users == 0 and sys.stdout is STDOUT_ROUTER:
+            sys.stdout = _stdout_original
+
+def _agent_print(*args, **kwargs):
+    """ Replaces the print function for agents, see :meth:`Game._agent_scope`. """
+    f = kwargs.get('file') or sys.stdout
+    f.write(kwargs.get('sep', ' ').join('%s'%(a,) for a in args) + kwargs.get('end', '\n'))
         
 class Team(object):
     """ Holds info about a team.
@@ -178,6 +339,9 @@ class Team(object):
     FIND_NAME   = r'^[ \t]*NAME[ \t]*=[ \t]*[\'\"]([a-zA-Z0-9\-\_ ]{3,20})[\'\"]'
     NAME_UNSAFE = r'[^a-zA-Z0-9\_]+'
     
+    # Compiled brain code, by sha1 digest of the source
+    COMPILED = {}
+    
     def __init__(self, brain=None, init_kwargs={}, name=None):
         """ Initialize a Team object.
         
@@ -226,11 +390,31 @@ class Team(object):
             return self.name_internal + ' (' + self.name_external + ')'
         
     def load(self, scope):
-        """ Load up the brain from the string 
+        """ Load up the brain from the string. The compiled code is 
+            cached by the hash of the string, so that repeated games 
+            only have to run it.
         """
-        exec(self.brain_string, scope)
+        source = self.brain_string
+        if isinstance(source, unicode):
+            key = hashlib.sha1(source.encode('utf-8')).digest()
+        else:
+            key = hashlib.sha1(source).digest()
+        code = Team.COMPILED.get(key)
+        if code is None:
+            code = Team.COMPILED[key] = compile(source, '<string>', 'exec')
+        exec(code, scope)
         return scope['Agent']
         
+def _accepts_argument(cls, name):
+    """ Whether the constructor of the given class takes an argument
+        with the given name, or any keyword arguments.
+    """
+    try:
+        args, varargs, keywords, defaults = inspect.getargspec(cls.__init__)
+    except TypeError:
+        return False
+    return name in args or keywords is not None
+        
 class AgentStub(object):
     """ Brains are replaced by this code when they can't
         be loaded for some reason.
@@ -254,6 +438,12 @@ class Game(object):
     SIMULATION_SUBSTEPS = 10
     SIMULATION_MAXITER  = 20
     
+    # Object uids are md5 digests of a counter, they determine the order 
+    # of collide() calls. They are computed once and shared by all games,
+    # which may be set up in different threads.
+    OBJECT_UIDS = []
+    OBJECT_UIDS_LOCK = threading.Lock()
+    
     STATE_NEW       = 0
     STATE_READY     = 1
     STATE_RUNNING   = 2
@@ -271,7 +461,9 @@ class Game(object):
                        rendered=True, 
                        verbose=True,
                        hard_errors=False,
-                       step_callback=None):
+                       step_callback=None,
+                       telemetry=False,
+                       log=None):
         """ Constructor for Game class 
             
             :param red:               Descriptor of the red agent.
@@ -289,16 +481,22 @@ class Game(object):
             :param verbose:           Print game log to output.
             :param hard_errors:       Enable to make agent errors interrupt the game.
             :param step_callback:     Function that is called on every step. Useful for debugging.
+            :param telemetry:         Record the scores, controlpoints and tanks in each step,
+                                        see :mod:`domination.telemetry`. Requires numpy.
+            :param log:               An instance of :class:`~domination.core.GameLog` to write
+                                        the game log to, to limit or spill its output.
         """
         self.record = record
+        self.use_telemetry = telemetry
         self.verbose = verbose
         self.step_callback = step_callback
         self.hard_errors = hard_errors
         
         # Public properties
-        self.log    = GameLog(self.verbose) #: The game log as an instance of class:`~domination.core.GameLog`
+        self.log    = log if log is not None else GameLog(self.verbose) #: The game log as an instance of class:`~domination.core.GameLog`
         self.replay = replay  #: The replay object, can be accessed after game has run
         self.stats  = None    #: Instance of :class:`~domination.core.GameStats`.
+        self.telemetry = None #: Instance of :class:`~domination.telemetry.Telemetry`, if enabled.
         self.red  = red if isinstance(red, Team) else Team(red, red_init)    #: Instance of :class:`~domination.core.Team`.
         self.blue = blue if isinstance(blue, Team) else Team(blue, blue_init) #: Instance of :class:`~domination.core.Team`.
         
@@ -330,27 +528,60 @@ class Game(object):
             self.renderer = None
         
         self.state = Game.STATE_NEW
+        self._captured = False
         
     def _agent_call(self, method, args=[], kwargs={}, team=TEAM_NEUTRAL, default=None):
         """ Calls a method on an agent, wrapping it in a try/catch block
             to prevent agents from crashing the game.
         """
-        if self.hard_errors:
-            return method(*args, **kwargs)
-        else:
-            try:
+        # Tag the output of the agent in the game log
+        source = self.log._source
+        self.log._source = LOG_SOURCES.get(team, LOG_ENGINE)
+        try:
+            if self.hard_errors:
                 return method(*args, **kwargs)
-            except Exception, e:
-                if team == TEAM_RED:
-                    self.red.raised_exception = True
-                else:
-                    self.blue.raised_exception = True
-                print "\n%s raised exception in < %s() >" % ('RED' if team == TEAM_RED else 'BLU', method.__name__)
-                print '-' * 60
-                traceback.print_exc(file=sys.stdout)
-                print '-' * 60
-                return default
+            else:
+                try:
+                    return method(*args, **kwargs)
+                except Exception, e:
+                    if team == TEAM_RED:
+                        self.red.raised_exception = True
+                    else:
+                        self.blue.raised_exception = True
+                    # Exceptions are never rate limited
+                    self.log._source = LOG_ENGINE
+                    print >> self.log, "\n%s raised exception in < %s() >" % ('RED' if team == TEAM_RED else 'BLU', method.__name__)
+                    print >> self.log, '-' * 60
+                    traceback.print_exc(file=self.log)
+                    print >> self.log, '-' * 60
+                    return default
+        finally:
+            self.log._source = source
             
+    def _agent_scope(self):
+        """ The globals that agent code is executed in. Agents that use
+            ``from __future__ import print_function`` get a print function
+            that, like the print statement, writes to sys.stdout, which 
+            sends their output to the game log while the game is running.
+        """
+        scope = AGENT_GLOBALS.copy()
+        scope['print'] = _agent_print
+        return scope
+        
+    def _capture(self):
+        """ Sends everything that is printed in the current thread to the
+            game log, until :meth:`_release` is called. Other threads, 
+            and the games running in them, are not affected.
+        """
+        if not self._captured:
+            self._captured_log = _capture_stdout(self.log)
+            self._captured = True
+        
+    def _release(self):
+        if self._captured:
+            _release_stdout(self._captured_log)
+            self._captured = False
+        
     def add_renderer(self, **kwargs):
         import renderer
         globals()['renderer'] = renderer
@@ -359,14 +590,11 @@ class Game(object):
     def _setup(self):
         """ Sets up the game.
         """
-        # Redirect STDOUT
-        self.old_stdout = sys.stdout
-        sys.stdout = self.log
         # Print version
-        print "Domination Game Ver. %s"%__version__
+        print >> self.log, "Domination Game Ver. %s"%__version__
         # Read agent brains (from string or file)
         
-        print "Playing `%s` vs. `%s`"%(self.red.fullname(), self.blue.fullname())
+        print >> self.log, "Playing `%s` vs. `%s`"%(self.red.fullname(), self.blue.fullname())
         
         self.random = random.Random()
         self.random.seed(RANDOMSEED)
@@ -391,6 +619,8 @@ class Game(object):
         self.objects         = []
         self.broadphase_mov  = []
         self.broadphase_stat = []
+        self.broadphase_version = 0
+        self._bulk_adding    = False
         # Performance tracking
         self.stats = GameStats()
         self.think_time_red        = 0.0
@@ -401,11 +631,11 @@ class Game(object):
         # Game objects
         self.tanks         = []
         self.controlpoints = []
-        for o in allobjects:
-            self._add_object(o)
+        self._add_objects(allobjects)
         self.controlpoints = cps
+        self.walls = [o for o in allobjects if isinstance(o, Wall)]
         # Initialize tanks
-        print "Initializing agents."
+        print >> self.log, "Initializing agents."
         if self.record or self.replay is None:
             # Initialize new tanks with brains
             brain_kwargs = {'settings': self.settings}
@@ -414,12 +644,16 @@ class Game(object):
                                      'field_grid': self.field.wallgrid,
                                      'nav_mesh': self.field.mesh})
             
-            red_brain_class = self._agent_call(self.red.load, kwargs={'scope':AGENT_GLOBALS.copy()}, team=TEAM_RED, default=AgentStub)
-            blue_brain_class = self._agent_call(self.blue.load, kwargs={'scope':AGENT_GLOBALS.copy()}, team=TEAM_BLUE, default=AgentStub)
+            red_brain_class = self._agent_call(self.red.load, kwargs={'scope':self._agent_scope()}, team=TEAM_RED, default=AgentStub)
+            blue_brain_class = self._agent_call(self.blue.load, kwargs={'scope':self._agent_scope()}, team=TEAM_BLUE, default=AgentStub)
             
             def construct_tanks(brainclass, init_kwargs, team, spawns):
                 for i,s in enumerate(spawns):
-                    kwargs = copy.deepcopy(brain_kwargs)
+                    # The field rects, grid and mesh are immutable, so they are shared.
+                    kwargs = dict(brain_kwargs)
+                    kwargs['settings'] = copy.deepcopy(self.settings)
+                    if self.settings.field_known and _accepts_argument(brainclass, 'flow_fields'):
+                        kwargs['flow_fields'] = self.field.flow_fields
                     kwargs.update(init_kwargs)
                     brain = self._agent_call(brainclass, args=[i, team], kwargs=kwargs, team=team, default=AgentStub())
                     t = Tank(s.x+2, s.y+2, s.angle, i, team=team, brain=brain, spawn=s, record=self.record)
@@ -442,50 +676,121 @@ class Game(object):
                 self._add_object(t)
         self.tanks_red = [tank for tank in self.tanks if tank.team == TEAM_RED]
         self.tanks_blue = [tank for tank in self.tanks if tank.team == TEAM_BLUE]
+        # Replays from older versions have no physics setting.
+        if getattr(self.settings, 'physics', PHYSICS_PYTHON) == PHYSICS_NUMPY:
+            import physics
+            self.physics = physics.ArrayPhysics(self)
+        else:
+            self.physics = None
+        self._raycaster = None
+        if getattr(self.settings, 'observation', OBSERVATION_LISTS) == OBSERVATION_ARRAYS:
+            import tensors
+            self.tensors = tensors.TensorObserver(self)
+        else:
+            self.tensors = None
+        if self.use_telemetry:
+            import telemetry
+            self.telemetry = telemetry.Telemetry(self)
+        self._observe_grid = collections.defaultdict(list)
+        self._observed_state = {}
+        self.team_observations = [TeamObservation(TEAM_RED), TeamObservation(TEAM_BLUE)]
+        for team_obs, tanks in zip(self.team_observations, (self.tanks_red, self.tanks_blue)):
+            team_obs.observations = [t.observation for t in tanks]
+        self._observe_kinds = {}
         self.state = Game.STATE_READY
         self.interrupted = False
         
     def run(self):
         """ Start and loop the game. """
+        for waiting in self._run():
+            while not self._poll_actions(waiting):
+                time.sleep(0.001)
+        return self # For chaining, if you're into that.
+        
+    def _run(self):
+        """ Runs the game as a generator that yields once every step,
+            with a list of the tanks that requested their actions 
+            (see :meth:`Tank.request_action`). It should be resumed once
+            :meth:`_poll_actions` says they're done. Used by :meth:`run` and, to interleave 
+            many games, by :class:`~domination.scheduler.GameScheduler`.
+        """
+        # Send the output of the agents in this thread to the log
+        self._capture()
+        try:
+            for waiting in self._loop():
+                # Other games may print while this one waits
+                self._release()
+                yield waiting
+                self._capture()
+        finally:
+            # Also when something raised, or the game was abandoned
+            self._release()
+            
+    def _poll_actions(self, tanks):
+        """ Returns whether the actions of the given tanks are done, 
+            see :meth:`Tank.poll_action`.
+        """
+        self._capture()
+        try:
+            # Not all(), every tank should see how long it waited
+            return all([tank.poll_action() for tank in tanks])
+        finally:
+            self._release()
+            
+    def _loop(self):
+        """ The body of :meth:`_run`, which handles the output capture. """
         if self.state != Game.STATE_READY:
             self._setup()
         res      = Game.SIMULATION_SUBSTEPS
         render   = self.renderer is not None
         settings = self.settings
+        substep  = self._substep if self.physics is None else self.physics.substep
         ## MAIN GAME LOOP
         self.state = Game.STATE_RUNNING
         try:
             for s in xrange(settings.max_steps):
                 self.step = s+1
+                self.log.step()
                 if self.step % 10 == 0:
-                    print "Step %d: %d - %d"%(self.step, self.score_red, self.score_blue)
+                    print >> self.log, "Step %d: %d - %d"%(self.step, self.score_red, self.score_blue)
                 if self.step_callback is not None:
                     self.step_callback(self)
                 ## UPDATE & CHECK VICTORY
                 p = time.clock()
                 for o in self.objects:
                     o.update()
+                self._observe()
+                if self.tensors is not None:
+                    self.tensors.update()
                 for t in self.tanks:
                     t.send_observation()
+                for t in self.tanks:
+                    t.request_action()
+                yield [t for t in self.tanks if t.pending is not None]
                 for t in self.tanks:
                     t.get_action()
                 # Compute shooting
                 for tank in self.tanks:
                     tank.hit = None
                     tank.clicked = []
-                    if tank.shoots:
-                        tcx, tcy = tank._x + tank.width/2, tank._y + tank.height/2
-                        target = (cos(tank.angle) * settings.max_range + tcx, 
-                                  sin(tank.angle) * settings.max_range + tcy)
-                        hits   = self._raycast((tcx, tcy), target, exclude=tank)
-                        tank._hitx, tank._hity = target
-                        if hits:
-                            t, (px,py), who = hits[0]
-                            tank._hitx, tank._hity = px, py
-                            if isinstance(who, Tank):
-                                tank.hit = who.team
-                                who.respawn_in = self.settings.spawn_time
-                
+                shooters = [tank for tank in self.tanks if tank.shoots]
+                origins  = [(tank._x + tank.width/2, tank._y + tank.height/2) for tank in shooters]
+                targets  = [(cos(tank.angle) * settings.max_range + tcx, 
+                             sin(tank.angle) * settings.max_range + tcy) 
+                            for (tank, (tcx, tcy)) in zip(shooters, origins)]
+                if self.physics is not None:
+                    hits = self.physics.raycast_many(origins, targets, exclude=shooters)
+                else:
+                    hits = [(self._raycast(p0, p1, exclude=tank) or [None])[0] 
+                            for (tank, p0, p1) in zip(shooters, origins, targets)]
+                for (tank, target, hit) in zip(shooters, targets, hits):
+                    tank._hitx, tank._hity = target
+                    if hit is not None:
+                        t, (px,py), who = hit
+                        tank._hitx, tank._hity = px, py
+                        if isinstance(who, Tank):
+                            tank.hit = who.team
+                            who.respawn_in = self.settings.spawn_time
                 # Record times
                 self.update_time_total += time.clock() - p
                 sum_red = sum(tank.time_thought for tank in self.tanks_red)
@@ -496,13 +801,14 @@ class Game(object):
                     self.think_time_red = sum_red / len(self.tanks_red)
                 if self.tanks_blue:
                     self.think_time_blue = sum_blue / len(self.tanks_blue)
-                # Score ending condition
-                if ((self.settings.end_condition & ENDGAME_SCORE) and 
-                    (self.score_red == 0 or self.score_blue == 0)):
-                    break
-                # No crumbs left ending condition
-                if ((self.settings.end_condition & ENDGAME_CRUMBS) and
-                    not any(True for o in allobjects if isinstance(o, Crumb))):
+                # Score ending condition, or no crumbs left ending condition
+                if (((self.settings.end_condition & ENDGAME_SCORE) and 
+                     (self.score_red == 0 or self.score_blue == 0)) or
+                    ((self.settings.end_condition & ENDGAME_CRUMBS) and
+                     not any(True for o in allobjects if isinstance(o, Crumb)))):
+                    # The tanks don't move in the last step
+                    if self.telemetry is not None:
+                        self.telemetry.update()
                     break
                 ## RESET SOME STUFF
                 if render:
@@ -541,22 +847,23 @@ class Game(object):
                 for step in xrange(res):
                     p = time.clock()
                     # Perform one physics substep
-                    self._substep()
+                    substep()
                     self.sim_time += time.clock() - p
                     if render:
-                        self.renderer.render(self)
+                        self.renderer.render(self, last=(step == res - 1))
                 self.sim_time_total += self.sim_time
                 for o in self.objects:
                     if o.movable:
                         o.x = o._x
                         o.y = o._y
                         o._a = o.angle = angle_fix(o.angle)
+                if self.telemetry is not None:
+                    self.telemetry.update()
         except GameInterrupt:
             self.state = Game.STATE_INTERRUPT
         except KeyboardInterrupt:
             self.state = Game.STATE_INTERRUPT
         self._end(interrupted=(self.state==Game.STATE_INTERRUPT))
-        return self # For chaining, if you're into that.
     
     def _end(self, interrupted=False):
         """ End the game  and tells all the agents that the game
@@ -565,26 +872,26 @@ class Game(object):
         if self.renderer is not None:
             self.renderer.quit()
         if interrupted:
-            print "Game was interrupted."
+            print >> self.log, "Game was interrupted."
             self.interrupted = True
         self.state = Game.STATE_ENDED
         self.stats.score_red = self.score_red
         self.stats.score_blue = self.score_blue
         self.stats.score = self.score_red / float(self.score_red + self.score_blue)
         self.stats.steps = self.step
-        print self.stats
+        print >> self.log, self.stats
         if self.record:
             self.replay.settings = copy.copy(self.settings)
             self.replay.field = self.field
             self.replay.actions_red = [tank.actions for tank in self.tanks_red]
             self.replay.actions_blue = [tank.actions for tank in self.tanks_blue]
+            self.replay.stats = copy.copy(self.stats)
         # Finalize tanks brains.
         if self.record or self.replay is None:
             for tank in self.tanks:
                 self._agent_call(tank.brain.finalize, args=[interrupted], team=tank.team)
-                    
-        # Set the stdout back to whatever it was before
-        sys.stdout = self.old_stdout
+        
+        self.log.close()
     
     def _substep(self):
         """ Performs a single physics substep. All objects are moved by
@@ -676,22 +983,52 @@ class Game(object):
     def _add_object(self,o):
         """ Add an object to the game and collision list. """
         o.game = self
-        o.uid = hashlib.md5(str(self.object_uid)).digest()
+        if self.object_uid >= len(Game.OBJECT_UIDS):
+            with Game.OBJECT_UIDS_LOCK:
+                Game.OBJECT_UIDS.extend(hashlib.md5(str(i)).digest() for i in 
+                                        xrange(len(Game.OBJECT_UIDS), 2 * self.object_uid + 64))
+        o.uid = Game.OBJECT_UIDS[self.object_uid]
         self.object_uid += 1
         self.objects.append(o)
         if o.physical:
+            self.broadphase_version += 1
             if o.movable:
                 self.broadphase_mov.append(o)
-                self.broadphase_mov.sort(key=lambda o:(o._x))
-            else:
+                if not self._bulk_adding:
+                    self.broadphase_mov.sort(key=lambda o:(o._x))
+            elif self._bulk_adding:
                 self.broadphase_stat.append(o)
-                self.broadphase_stat.sort(key=lambda o:(o._x))
+            else:
+                # Insert after the objects with the same _x, like a stable sort would.
+                stat, x = self.broadphase_stat, o._x
+                lo, hi = 0, len(stat)
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if x < stat[mid]._x:
+                        hi = mid
+                    else:
+                        lo = mid + 1
+                stat.insert(lo, o)
         o.added_to_game(self)
+    
+    def _add_objects(self, objects):
+        """ Add a batch of objects, sorting the collision lists
+            only once at the end.
+        """
+        self._bulk_adding = True
+        try:
+            for o in objects:
+                self._add_object(o)
+        finally:
+            self._bulk_adding = False
+        self.broadphase_mov.sort(key=lambda o:(o._x))
+        self.broadphase_stat.sort(key=lambda o:(o._x))
         
     def _rem_object(self,o):
         """ Removes an object from the game and collision lists. """
         self.objects.remove(o)
         if o.physical:
+            self.broadphase_version += 1
             if o.movable:
                 self.broadphase_mov.remove(o)
             else:
@@ -717,6 +1054,87 @@ class Game(object):
                 if ymin < (o._y + o.height) and o._y < ymax:
                     yield o
     
+    def _observe(self):
+        """ Fills the friends, foes, objects and controlpoints in the 
+            observations of all tanks, and the team observations, 
+            in one pass over the objects. 
+            Tanks are put in a grid with cells as large as their field
+            of view, so each object is only tested against the tanks in 
+            the surrounding cells. The lists in the observations are 
+            reused every step.
+        """
+        rng = self.settings.max_see
+        cell = float(rng + max(Tank.SIZE_VACUBOT, Ammo.SIZE))
+        grid = self._observe_grid
+        kinds = self._observe_kinds
+        team_observations = self.team_observations
+        for tanks in grid.itervalues():
+            del tanks[:]
+        # The controlpoints are a tuple, so all observations can share it
+        cps = tuple((cp.cx,cp.cy,cp.team) for cp in self.controlpoints)
+        last_state = self._observed_state
+        for team_obs, tanks in zip(team_observations, (self.tanks_red, self.tanks_blue)):
+            team_obs.step = self.step
+            team_obs.score = (self.score_red, self.score_blue)
+            team_obs.cps = cps
+            del team_obs.foes[:]
+            # What changed for each tank since the previous step
+            deltas = []
+            for t in tanks:
+                siz = t.width / 2.0
+                state = (int(t.x+siz), int(t.y+siz), t.ammo)
+                x, y, ammo = last_state.get(t, state)
+                deltas.append((state[0] - x, state[1] - y, state[2] - ammo))
+                last_state[t] = state
+            team_obs.deltas = tuple(deltas)
+        for t in self.tanks:
+            obs = t.observation
+            del obs.friends[:]
+            del obs.foes[:]
+            del obs.objects[:]
+            obs.cps = cps
+            grid[int(t.x // cell), int(t.y // cell)].append(t)
+        for objects in (self.broadphase_mov, self.broadphase_stat):
+            for o in objects:
+                cls = o.__class__
+                kind = kinds.get(cls, -1)
+                if kind == -1:
+                    if issubclass(cls, Tank):
+                        kind = kinds[cls] = None
+                    elif issubclass(cls, Ammo):
+                        kind = kinds[cls] = "Ammo"
+                    elif issubclass(cls, Crumb):
+                        kind = kinds[cls] = "Crumb"
+                    else:
+                        kind = kinds[cls] = False
+                if kind is False:
+                    continue
+                ox, oy = o._x, o._y
+                oxmax, oymax = ox + o.width, oy + o.height
+                gx, gy = int(ox // cell), int(oy // cell)
+                seen = False
+                for i in (gx - 1, gx, gx + 1):
+                    for j in (gy - 1, gy, gy + 1):
+                        if (i, j) not in grid:
+                            continue
+                        for t in grid[i, j]:
+                            if (ox <= t.x + t.width + rng and oxmax > t.x - rng and
+                                t.y - rng < oymax and oy < t.y + t.height + rng):
+                                obs = t.observation
+                                if kind is None:
+                                    siz = t.width / 2.0
+                                    if o.team == t.team:
+                                        if o is not t:
+                                            obs.friends.append((int(ox+siz), int(oy+siz)))
+                                    else:
+                                        foe = (int(ox+siz), int(oy+siz), o._a)
+                                        obs.foes.append(foe)
+                                        if not seen:
+                                            team_observations[t.team].foes.append(foe)
+                                            seen = True
+                                else:
+                                    obs.objects.append((o.cx, o.cy, kind))
+    
     def _compute_separation(self, object1, object2):
         """ Compute object separation/penetration
             Returns a tuple or None.
@@ -815,19 +1233,22 @@ class Game(object):
     def _raycast(self, p0, p1, exclude=None):
         """ Shoots a ray from p0 to p1 and determines
             which objects are hit and at what time
-            in the parametric line equation p0 + t * (p1 - p0)
+            in the parametric line equation p0 + t * (p1 - p0).
+            Walls (the only solid static objects) are found by walking
+            the tiles that the ray crosses, so only the first wall that
+            is hit is returned, along with all movable objects.
         """
         p0x, p0y = p0
         p1x, p1y = p1
         xmin, xmax = (p0x, p1x) if p0x < p1x else (p1x, p0x)
         ymin, ymax = (p0y, p1y) if p0y < p1y else (p1y, p0y)
-        
-        # List collided pairs
-        in_box = self._get_objects_in_bounds(xmin,xmax,ymin,ymax)
-        # Determine actual hits
         hits = []
-        for o in in_box:
-            if o != exclude:
+        # Determine hits on movable objects
+        for o in self.broadphase_mov:
+            if o._x > xmax:
+                break
+            if (o.solid and o._x + o.width > xmin and 
+                ymin < (o._y + o.height) and o._y < ymax and o != exclude):
                 if o.shape == GameObject.SHAPE_RECT:
                     isect = line_intersects_rect(p0,p1,(o._x,o._y,o.width,o.height))
                     if isect:
@@ -839,9 +1260,40 @@ class Game(object):
                     if isect:
                         # Append the t0 (intersection time), position and object
                         hits.append((isect[0][0],isect[0][1],o))
+        # Find the first wall along the ray
+        wallcells = self.field.wallcells
+        for (j, i) in line_grid_hits(p0, p1, wallcells, self.field.tilesize):
+            wall = self.walls[wallcells[i][j] - 1]
+            if (wall._x <= xmax and wall._x + wall.width > xmin and
+                ymin < (wall._y + wall.height) and wall._y < ymax and wall != exclude):
+                isect = line_intersects_rect(p0,p1,(wall._x,wall._y,wall.width,wall.height))
+                if isect:
+                    hits.append((isect[0][0],isect[0][1],wall))
+                    break
         hits.sort(key=lambda h: h[0])
         return hits
     
+    def raycast_many(self, origins, targets, exclude=None):
+        """ Shoots a ray from each of the origins to the corresponding
+            target, and determines the first solid object that each of 
+            them hits. The rays are resolved together, so this is much 
+            faster than separate calls for large numbers of rays. 
+            Requires numpy.
+            
+            :param origins: A list of (x, y) tuples where the rays start.
+            :param targets: A list of (x, y) tuples where the rays end.
+            :param exclude: A list with an object that each ray should 
+                            ignore (e.g. the shooter), or None.
+            :returns: A list with for each ray either None or a tuple
+                      (t, (x, y), object) of the first hit.
+        """
+        if self.physics is None:
+            if self._raycaster is None:
+                import physics
+                self._raycaster = physics.ArrayPhysics(self)
+            return self._raycaster.raycast_many(origins, targets, exclude)
+        return self.physics.raycast_many(origins, targets, exclude)
+    
     def _click(self, (x,y), shift):
         """ Tells the game that the right-mouse button was clicked
             somewhere on the field.
@@ -1055,7 +1507,10 @@ class Field(object):
         _unpacked = {'wallrects':[],
                      'objects': [],
                      'mesh': None,
-                     'grid': None}
+                     'grid': None,
+                     'wallcells': None,
+                     'flowfields': None,
+                     'patches': {}}
         
         def create_object(x, y, marker):
             """ Creates an object from a tile marker """
@@ -1088,17 +1543,26 @@ class Field(object):
                     _unpacked["objects"].append(create_object(j, i, tile))
 
         # Optimize the walls and generate Wall objects
-        _unpacked['wallrects'] = rects_merge(_unpacked['wallrects'])
+        _unpacked['wallrects'] = tuple(rects_merge(_unpacked['wallrects']))
         _unpacked['objects'].extend( (Wall, {'x':x, 'y':y, 'width':w, 'height':h}) 
                                         for (x,y,w,h) in _unpacked['wallrects'] )
         
         # Generate nav mesh
         add_points = [(o.cx, o.cy) for o in _unpacked['objects'] if 
                         (isinstance(o,Ammo) or isinstance(o,ControlPoint))]
-        _unpacked['mesh'] = make_nav_mesh(_unpacked['wallrects'], simplify=0.3,add_points=add_points)
+        _unpacked['mesh'] = NavMesh(make_nav_mesh(_unpacked['wallrects'], simplify=0.3,add_points=add_points))
         
         # Generate wall grid
-        _unpacked['grid'] = [[(1 if t == self.WALL else 0) for t in row] for row in self.tiles]
+        _unpacked['grid'] = tuple(tuple((1 if t == self.WALL else 0) for t in row) for row in self.tiles)
+        
+        # Map each wall tile to its (1-based) index in the wall rects, so 
+        # that rays can find the walls they hit by walking the tiles.
+        wallcells = [[0] * self.width for _ in xrange(self.height)]
+        for k, (x, y, w, h) in enumerate(_unpacked['wallrects']):
+            for i in xrange(y // self.tilesize, (y + h) // self.tilesize):
+                for j in xrange(x // self.tilesize, (x + w) // self.tilesize):
+                    wallcells[i][j] = k + 1
+        _unpacked['wallcells'] = wallcells
 
         self._unpacked = _unpacked
         
@@ -1117,10 +1581,50 @@ class Field(object):
         if not self._unpacked: self.unpack()
         return self._unpacked['wallrects']
     
+    @property
+    def flow_fields(self):
+        """ Shortest paths over the tiles towards any target, see 
+            :class:`~domination.utilities.FlowFields`. These are computed 
+            when they are first needed, and shared by all games on this field.
+        """
+        if not self._unpacked: self.unpack()
+        if self._unpacked['flowfields'] is None:
+            self._unpacked['flowfields'] = FlowFields(self.wallgrid, self.tilesize)
+        return self._unpacked['flowfields']
+    
+    @property
+    def wallcells(self):
+        if not self._unpacked: self.unpack()
+        return self._unpacked['wallcells']
+    
     def get_objects(self):
-        """ Creates the gameobjects and returns them """
+        """ Creates the gameobjects and returns them. Every game gets
+            its own objects, because games set their game and uid. The
+            walls come last.
+        """
+        if not self._unpacked: self.unpack()
+        objects = self._unpacked['objects']
+        return ([cls(**kwargs) for (cls, kwargs) in objects if cls is not Wall] + 
+                [cls(**kwargs) for (cls, kwargs) in objects if cls is Wall])
+    
+    def wall_patch(self, x, y, radius):
+        """ Returns the walls around tile (x, y) as a (2*radius+1)-square
+            patch, with everything outside the field counted as wall. 
+            Patches are tuples of tuples, computed once per tile and
+            radius, and shared.
+        """
         if not self._unpacked: self.unpack()
-        return [cls(**kwargs) for (cls, kwargs) in self._unpacked['objects']]
+        patches = self._unpacked['patches'].get(radius)
+        if patches is None:
+            patches = self._unpacked['patches'][radius] = {}
+        patch = patches.get((x, y))
+        if patch is None:
+            w, h, grid = self.width, self.height, self.wallgrid
+            patch = patches[(x, y)] = tuple(
+                tuple((grid[i][j] if (0 <= i < h and 0 <= j < w) else 1)
+                      for j in xrange(x - radius, x + radius + 1))
+                for i in xrange(y - radius, y + radius + 1))
+        return patch
     
         
 class FieldGenerator(object):
@@ -1247,6 +1751,13 @@ class FieldGenerator(object):
 class GameObject(object):
     """ Generic game object """
     
+    # Game objects are created in large numbers (crumbs) and their attributes
+    # are read constantly by the collision solver, so they don't get a __dict__.
+    # Subclasses need to declare their own __slots__ as well.
+    __slots__ = ('game', 'uid', 'parent', 'x', 'y', 'width', 'height', 'angle', 
+                 'shape', 'solid', 'movable', 'physical', 'graphic', 'cx', 'cy',
+                 '_x', '_y', '_a', '_dx', '_dy', '_da', '_moved')
+    
     SHAPE_RECT = 0
     SHAPE_CIRC = 1
     
@@ -1311,7 +1822,20 @@ class GameObject(object):
         
 ## Gameobject Subclasses
 
+class _DefaultAction(object):
+    """ Takes the place of a pending action that raised or timed out. """
+    def done(self):
+        return True
+        
+    def result(self):
+        return (0, 0, False)
+
 class Tank(GameObject):
+    __slots__ = ('brain', 'id', 'team', 'ammo', 'selected', 'clicked', 'shoots', 
+                 'hit', 'respawn_in', 'spawn', 'actions', 'record', 'time_thought',
+                 'observation', '_hitx', '_hity', 'grid_x', 'grid_y', 'pending',
+                 'requested')
+    
     SIZE = 12
     SIZE_VACUBOT = 16
     
@@ -1338,6 +1862,8 @@ class Tank(GameObject):
         self.actions = actions if actions is not None else []
         self.record = record
         self.time_thought = 0.0
+        self.pending = None #: The action requested by :meth:`request_action`
+        self.requested = None # When it was requested, until it's done
         # Additional hidden vars
         self._hitx = 0.0
         self._hity = 0.0
@@ -1365,7 +1891,10 @@ class Tank(GameObject):
             self.respawn_in -= 1
             
     def send_observation(self):
-        """ Send an observation to this agent's brain, if it has one """
+        """ Send an observation to this agent's brain, if it has one.
+            The visible objects are filled in beforehand by 
+            :meth:`Game._observe`.
+        """
         rng = self.game.settings.max_see
         obs = self.observation
         siz = self.width / 2.0
@@ -1373,52 +1902,71 @@ class Tank(GameObject):
         obs.loc        = mx, my = (int(self.x+siz), int(self.y+siz))
         obs.angle      = self.angle
         obs.ammo       = self.ammo
-        obs.friends    = []
-        obs.foes       = []
-        obs.objects    = []
         obs.respawn_in = self.respawn_in
         obs.hit        = self.hit
         obs.score      = (self.game.score_red, self.game.score_blue)
         obs.selected   = self.selected
         obs.clicked    = self.clicked
         obs.keys       = self.game.keys
-        close = self.game._get_objects_in_bounds(self.x - rng, self.x + self.width + rng,
-                    self.y - rng, self.y + self.height + rng, solid_only=False)
-        
-        for o in close:
-            if isinstance(o, Tank):
-                if o.team == self.team:
-                    if o != self:
-                        obs.friends.append((int(o._x+siz), int(o._y+siz)))
-                else:
-                    obs.foes.append((int(o._x+siz), int(o._y+siz), o._a))
-            elif isinstance(o, Ammo):
-                obs.objects.append((o.cx, o.cy, "Ammo"))
-            elif isinstance(o, Crumb):
-                obs.objects.append((o.cx, o.cy, "Crumb"))
-        obs.cps = [(cp.cx,cp.cy,cp.team) for cp in self.game.controlpoints]
         # Observe walls
         f = self.game.field
         xj, yi = mx//f.tilesize, my//f.tilesize
-        # Only regenerate grid if we moved to another cell.
+        # Only copy the walls if we moved to another cell.
         if xj != self.grid_x or yi != self.grid_y:
-            gridrng = (rng/2+1)//f.tilesize
-            w,h = f.width, f.height
-            for oi,i in enumerate(xrange(yi-gridrng, yi+gridrng+1)):
-                for oj,j in enumerate(xrange(xj-gridrng, xj+gridrng+1)):
-                    if (i >= 0 and j >= 0 and i < h and j < w and
-                        f.wallgrid[i][j] == 0):
-                        obs.walls[oi][oj] = 0
-                    else:
-                        obs.walls[oi][oj] = 1
+            patch = f.wall_patch(xj, yi, (rng/2+1)//f.tilesize)
+            for oi in xrange(len(patch)):
+                obs.walls[oi][:] = patch[oi]
             self.grid_x = xj
             self.grid_y = yi
         
         last_clock = time.clock()
         if self.brain is not None:
+            if hasattr(self.brain, 'observe_team'):
+                self.game._agent_call(self.brain.observe_team, 
+                                      args=[self.game.team_observations[self.team]], team=self.team)
             self.game._agent_call(self.brain.observe, args=[obs], team=self.team)
         self.time_thought = time.clock() - last_clock
         
+    def request_action(self):
+        """ Asks the brain for an action without waiting for it, if the 
+            brain has an ``action_async`` method. It should return an object
+            like :class:`concurrent.futures.Future`, with a ``done()`` method
+            and a ``result()`` method that returns the action tuple.
+        """
+        self.pending = None
+        self.requested = None
+        if (self.record or not self.actions) and hasattr(self.brain, 'action_async'):
+            last_clock = time.clock()
+            self.pending = self.game._agent_call(self.brain.action_async, team=self.team)
+            self.time_thought += time.clock() - last_clock
+            if self.pending is not None:
+                self.requested = time.time()
+        
+    def poll_action(self):
+        """ Returns whether the action from :meth:`request_action` is done.
+            Only the time spent in ``done()`` counts as thinking time, since
+            a scheduler may be busy with other games in between. If checking
+            raises an exception, or the action isn't done within 
+            :attr:`Settings.async_timeout`, the tank gets the default action.
+        """
+        if self.requested is None:
+            return True
+        failed = []
+        last_clock = time.clock()
+        done = self.game._agent_call(self.pending.done, team=self.team, default=failed)
+        self.time_thought += time.clock() - last_clock
+        if done is failed:
+            self.pending = _DefaultAction()
+        elif not done:
+            waited = time.time() - self.requested
+            if waited <= self.game.settings.async_timeout:
+                return False
+            self.pending = _DefaultAction()
+            print >> self.game.log, '[Game]: Agent %s-%d timed out waiting for its action (%.3fs).'%(
+                'RED' if self.team == TEAM_RED else 'BLU', self.id, waited)
+        self.requested = None
+        return True
+        
     def get_action(self):
         ## Ask brain for action (or replay)
         if not self.record and self.actions:
@@ -1429,17 +1977,21 @@ class Tank(GameObject):
             last_clock = time.clock()
             
             def _act():
-                action = self.brain.action()
+                if self.pending is not None:
+                    action = self.pending.result()
+                else:
+                    action = self.brain.action()
                 if action is None or len(action) != 3:
                     raise Exception("Action should be a 3-tuple of (turn, speed, shoot)")
                 return action
             
             (turn, speed, shoot) = self.game._agent_call(_act, default=(0,0,False), team=self.team)
+            self.pending = None
             self.time_thought += time.clock() - last_clock
             # Ignore action (NO-OP) if agent thought too long.
             if self.time_thought > self.game.settings.think_time:
                 (turn, speed, shoot) = (0,0,False)
-                print '[Game]: Agent %s-%d timed out (%.3fs).'%('RED'if self.team==0 else 'BLU',self.id,self.time_thought)
+                print >> self.game.log, '[Game]: Agent %s-%d timed out (%.3fs).'%('RED'if self.team==0 else 'BLU',self.id,self.time_thought)
             if self.record:
                 self.actions.append((turn,speed,shoot))
             if self.game.renderer is not None and self.game.renderer.active_team == self.team:
@@ -1469,6 +2021,8 @@ class Tank(GameObject):
             
 
 class Wall(GameObject):
+    __slots__ = ()
+    
     def __init__(self, **kwargs):
         kwargs['graphic'] = None
         kwargs['movable'] = False
@@ -1476,6 +2030,8 @@ class Wall(GameObject):
         super(Wall, self).__init__(**kwargs)
 
 class ControlPoint(GameObject):
+    __slots__ = ('team', 'collided')
+    
     SIZE = 24
     def __init__(self,x,y):
         super(ControlPoint, self).__init__(x=x, y=y, width=ControlPoint.SIZE, height=ControlPoint.SIZE, shape=GameObject.SHAPE_CIRC, 
@@ -1521,6 +2077,8 @@ class ControlPoint(GameObject):
 class Ammo(GameObject):
     """ Represents an ammo pack.
     """
+    __slots__ = ('pickedup',)
+    
     SIZE    = 16
     GRAPHIC = 'ammo_full'
     def __init__(self,x,y):
@@ -1544,6 +2102,8 @@ class Crumb(Ammo):
         up, with no other purpose than being registered
         as picked up. Essentially a small ammo packet.
     """
+    __slots__ = ()
+    
     SIZE = 4
     GRAPHIC = 'crumb'
 
@@ -1552,6 +2112,8 @@ class Fountain(GameObject):
         regular intervals, or when there are too few
         of its 'child' objects on the map.
     """
+    __slots__ = ('countdown', 'delay', 'children', 'initialized')
+    
     MIN_CHILDREN = 1
     DELAY        = 10
     CHILD_CLASS  = Ammo
@@ -1566,6 +2128,7 @@ class Fountain(GameObject):
                                    shape=GameObject.SHAPE_RECT, solid=False, 
                                    movable=False, physical=False, graphic=self.GRAPHIC)
         self.countdown = -1
+        self.delay = self.DELAY
         self.children = []
         self.initialized = False
         
@@ -1578,7 +2141,7 @@ class Fountain(GameObject):
         if self.countdown > -1:
             self.countdown -= 1         
         if self.countdown == -1 and len(self.children) < self.MIN_CHILDREN:
-            self.countdown = self.DELAY
+            self.countdown = self.delay
         if self.countdown == 0:
             self.spawn_one()
             
@@ -1600,15 +2163,19 @@ class Fountain(GameObject):
             attempts -= 1
             
 class AmmoFountain(Fountain):
+    __slots__ = ()
+    
     MIN_CHILDREN = 1
     CHILD_CLASS  = Ammo
     GRAPHIC      = 'ammo_empty'
             
     def added_to_game(self, game):
-        self.DELAY = self.game.settings.ammo_rate
+        self.delay = self.game.settings.ammo_rate
         super(AmmoFountain, self).added_to_game(game)
                 
 class CrumbFountain(Fountain):
+    __slots__ = ()
+    
     MIN_CHILDREN = 200
     DELAY        = -1
     CHILD_CLASS  = Crumb
@@ -1617,6 +2184,8 @@ class CrumbFountain(Fountain):
         return x + self.game.random.gauss(0, 32), y + self.game.random.gauss(0, 32)
 
 class TankSpawn(GameObject):
+    __slots__ = ('team',)
+    
     SIZE = 16
     def __init__(self,x=0, y=0, angle=0, team=TEAM_RED, brain=None):
         super(TankSpawn, self).__init__(x=x, y=y, angle=angle, width=TankSpawn.SIZE, height=TankSpawn.SIZE, 
@@ -1625,14 +2194,19 @@ class TankSpawn(GameObject):
         self.graphic = 'spawn_red' if self.team == TEAM_RED else 'spawn_blue'
 
 class Observation(object):
+    __slots__ = ('step', 'loc', 'angle', 'walls', 'friends', 'foes', 'cps', 'objects',
+                 'ammo', 'score', 'collided', 'respawn_in', 'hit', 'selected',
+                 'clicked', 'keys', 'spatial', 'features')
+    
     def __init__(self):
         self.step       = 0     #: Current timestep
         self.loc        = (0,0) #: Agent's location (x,y)
         self.angle      = 0     #: Current angle in radians
         self.walls      = []    #: Visible walls around the agent: a 2D binary array
+        # The lists below are refilled every step, copy them to keep them.
         self.friends    = []    #: All/Visible friends: a list of (x,y,angle)-tuples
         self.foes       = []    #: Visible foes: a list of (x,y,angle)-tuples
-        self.cps        = []    #: Controlpoints: a list of (x,y,TEAM_RED/TEAM_BLUE)-tuples
+        self.cps        = ()    #: Controlpoints: a tuple of (x,y,TEAM_RED/TEAM_BLUE)-tuples
         self.objects    = []    #: Visible objects: a list of (x,y,type)-tuples
         self.ammo       = 0     #: Ammo count
         self.score      = (0,0) #: Current game score
@@ -1644,13 +2218,40 @@ class Observation(object):
         self.selected = False   #: Indicates if the agent is selected in the UI
         self.clicked = []       #: A list of mouse-clicks, tuples of (x, y, shift, selected)
         self.keys = []          #: A list of all keys pressed in the previous turn
+        # The following properties are only set when the settings
+        # select OBSERVATION_ARRAYS, see domination.tensors:
+        self.spatial = None     #: A uint8 array of (channel, y, x) tiles around the agent
+        self.features = None    #: A float32 array of scalar features
         
     def __str__(self):
-        items = sorted(self.__dict__.items())
+        items = sorted((k, getattr(self, k)) for k in self.__slots__)
         maxlen = max(len(k) for k,v in items)
         return "== Observation ==\n" + "\n".join(('%s : %r'%(k.ljust(maxlen), v)) for (k,v) in items)
         
 
+class TeamObservation(object):
+    """ What a whole team observes in a step. It is computed once per
+        team per step, and passed to the ``observe_team`` method of
+        agents that have one, right before their own observation.
+    """
+    __slots__ = ('team', 'step', 'score', 'cps', 'foes', 'deltas', 'observations')
+    
+    def __init__(self, team):
+        self.team         = team  #: TEAM_RED/TEAM_BLUE
+        self.step         = 0     #: Current timestep
+        self.score        = (0,0) #: Current game score
+        self.cps          = ()    #: Controlpoints: the same tuple as in the agents' observations
+        self.foes         = []    #: Foes seen by any agent in the team: a list of (x,y,angle)-tuples
+        self.deltas       = ()    #: Change in location and ammo of each agent since the previous step,
+                                  #: by id: a tuple of (dx,dy,ammo)-tuples
+        self.observations = []    #: The individual observations of the team's agents, by id
+    
+    def __str__(self):
+        items = sorted((k, getattr(self, k)) for k in self.__slots__ if k != 'observations')
+        maxlen = max(len(k) for k,v in items)
+        return "== TeamObservation ==\n" + "\n".join(('%s : %r'%(k.ljust(maxlen), v)) for (k,v) in items)
+        
+
 class ReplayData(object):
     """ Contains the replaydata for a game. """
     def __init__(self, game):
@@ -1658,6 +2259,7 @@ class ReplayData(object):
         self.version = __version__
         self.actions_red  = [] # List of lists of red agents' actions
         self.actions_blue = [] # List of lists of blue agents' actions        
+        self.stats = None # The GameStats of the recorded game
 
     def play(self):
         """ Convenience method for setting up a game to play this replay. 
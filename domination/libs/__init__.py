@@ -1 +1 @@
-__all__ = ["munkres", "astar"]
\ No newline at end of file
+__all__ = ["munkres", "astar", "assignment"]
\ No newline at end of file
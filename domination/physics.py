@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+""" Vectorized physics for the domination game engine.
+
+This module solves the movement and collisions of a game substep, and
+the rays of shooting tanks, with whole-array passes in NumPy instead of
+one object pair at a time. It is used by :class:`~domination.core.Game`
+when the settings select :data:`~domination.core.PHYSICS_NUMPY`, and by
+:meth:`~domination.core.Game.raycast_many`. You'll never need to call
+anything from this module explicitly.
+
+"""
+__author__ = "Thomas van den Berg and Tim Doolan"
+
+### IMPORTS ###
+# Libraries
+import numpy as np
+
+### CLASSES ###
+
+class ArrayPhysics(object):
+    """ Structure-of-arrays store for the objects in a game.
+
+        The positions, deltas, sizes and flags of the movable objects, and
+        the bounds of the static ones, are kept in NumPy arrays. The game
+        objects stay the owners of their state: the movable arrays are
+        filled from the objects at the start of every substep and written
+        back at the end, so that the renderer, the observations and the
+        collide() callbacks can keep reading plain attributes. The static
+        arrays are only rebuilt when objects are added or removed.
+
+        The solver follows :meth:`~domination.core.Game._substep`:
+        penetrations are detected for all pairs at once, and then resolved
+        deepest first, moving each object at most once per iteration.
+        Only circular movables (tanks) are supported.
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.broadphase_version = -1
+        self.num_movable = -1
+
+    def _load_static(self):
+        """ (Re)builds the arrays for static objects. """
+        stat = self.game.broadphase_stat
+        n = len(stat)
+        self.stat    = list(stat)
+        self.s_l     = np.fromiter((o._x for o in stat), float, n)
+        self.s_t     = np.fromiter((o._y for o in stat), float, n)
+        self.s_w     = np.fromiter((o.width for o in stat), float, n)
+        self.s_h     = np.fromiter((o.height for o in stat), float, n)
+        self.s_r     = self.s_l + self.s_w
+        self.s_b     = self.s_t + self.s_h
+        self.s_circ  = np.fromiter((o.shape == o.SHAPE_CIRC for o in stat), bool, n)
+        self.s_solid = np.fromiter((o.solid for o in stat), bool, n)
+        self.broadphase_version = self.game.broadphase_version
+
+    def _load_movable(self):
+        """ Fills the arrays for movable objects and applies their
+            deltas for this substep.
+        """
+        mov = self.game.broadphase_mov
+        n = len(mov)
+        if n != self.num_movable:
+            self.num_movable = n
+            self.pair_i, self.pair_j = np.triu_indices(n, 1)
+        self.mov   = list(mov)
+        self.x     = np.fromiter((o._x + o._dx for o in mov), float, n)
+        self.y     = np.fromiter((o._y + o._dy for o in mov), float, n)
+        self.w     = np.fromiter((o.width for o in mov), float, n)
+        self.h     = np.fromiter((o.height for o in mov), float, n)
+        self.solid = np.fromiter((o.solid for o in mov), bool, n)
+
+    def substep(self):
+        """ Performs a single physics substep, like
+            :meth:`~domination.core.Game._substep`.
+        """
+        game = self.game
+        if self.broadphase_version != game.broadphase_version:
+            self._load_static()
+        self._load_movable()
+        mov, stat = self.mov, self.stat
+        x, y = self.x, self.y
+        moved = np.ones(len(mov), dtype=bool)
+        pairs = set([])
+        something_collided = True
+        iteration = game.SIMULATION_MAXITER
+        while something_collided and iteration > 0:
+            # Detect separations of all candidate pairs
+            (mi, mj, mp, mpx, mpy) = self._movable_separations(moved)
+            (si, sk, sp, spx, spy) = self._static_separations(moved)
+            for i, j in zip(mi, mj):
+                o1, o2 = mov[i], mov[j]
+                if (o1, o2) not in pairs:
+                    pairs.add((o2, o1))
+            for i, k in zip(si, sk):
+                o1, o2 = mov[i], stat[k]
+                if (o1, o2) not in pairs:
+                    pairs.add((o2, o1))
+            # Only solid pairs are separated
+            msolid = self.solid[mi] & self.solid[mj]
+            ssolid = self.solid[si] & self.s_solid[sk]
+            p  = np.concatenate((mp[msolid], sp[ssolid]))
+            i  = np.concatenate((mi[msolid], si[ssolid]))
+            j  = np.concatenate((mj[msolid], -np.ones(ssolid.sum(), dtype=int)))
+            px = np.concatenate((mpx[msolid], spx[ssolid]))
+            py = np.concatenate((mpy[msolid], spy[ssolid]))
+            something_collided = len(p) > 0
+            # Resolve collisions with the largest penetration first.
+            moved[:] = False
+            for c in np.argsort(-p, kind='mergesort'):
+                if p[c] < 1:
+                    break
+                o1, o2 = i[c], j[c]
+                if moved[o1]:
+                    continue
+                if o2 >= 0:
+                    if moved[o2]:
+                        continue
+                    dx = px[c] / 2
+                    dy = py[c] / 2
+                    x[o1] += dx
+                    y[o1] += dy
+                    x[o2] -= dx
+                    y[o2] -= dy
+                    moved[o2] = True
+                else:
+                    x[o1] += px[c]
+                    y[o1] += py[c]
+                moved[o1] = True
+            iteration -= 1
+        # Write the positions back to the objects
+        for k, o in enumerate(mov):
+            o._x = float(x[k])
+            o._y = float(y[k])
+        game.broadphase_mov.sort(key=lambda o:(o._x))
+        pairs = sorted(pairs)
+        for (o1,o2) in pairs:
+            o1.collide(o2)
+            o2.collide(o1)
+
+    def raycast_many(self, origins, targets, exclude=None):
+        """ Resolves many rays at once against all solid objects, see
+            :meth:`~domination.core.Game.raycast_many`. Gives the same 
+            hits as :meth:`~domination.core.Game._raycast`, including its
+            bounding box test and the order in which ties are broken.
+        """
+        game = self.game
+        if self.broadphase_version != game.broadphase_version:
+            self._load_static()
+        num_rays = len(origins)
+        if num_rays == 0:
+            return []
+        # Movable objects in their current position, then static ones,
+        # just like Game._get_objects_in_bounds yields them.
+        mov = game.broadphase_mov
+        n = len(mov)
+        objects = mov + self.stat
+        l = np.concatenate((np.fromiter((o._x for o in mov), float, n), self.s_l))
+        t = np.concatenate((np.fromiter((o._y for o in mov), float, n), self.s_t))
+        w = np.concatenate((np.fromiter((o.width for o in mov), float, n), self.s_w))
+        h = np.concatenate((np.fromiter((o.height for o in mov), float, n), self.s_h))
+        circ = np.concatenate((np.fromiter((o.shape == o.SHAPE_CIRC for o in mov), bool, n), self.s_circ))
+        solid = np.concatenate((np.fromiter((o.solid for o in mov), bool, n), self.s_solid))
+        r, b = l + w, t + h
+        # Rays are rows, objects are columns
+        p0 = np.asarray(origins, dtype=float)
+        p1 = np.asarray(targets, dtype=float)
+        x0, y0 = p0[:,0:1], p0[:,1:2]
+        dx, dy = p1[:,0:1] - x0, p1[:,1:2] - y0
+        xmin, xmax = np.minimum(x0, p1[:,0:1]), np.maximum(x0, p1[:,0:1])
+        ymin, ymax = np.minimum(y0, p1[:,1:2]), np.maximum(y0, p1[:,1:2])
+        cand = solid & (l <= xmax) & (r > xmin) & (ymin < b) & (t < ymax)
+        if exclude is not None:
+            index = dict((id(o), k) for (k, o) in enumerate(objects))
+            for (ray, o) in enumerate(exclude):
+                if o is not None and id(o) in index:
+                    cand[ray, index[id(o)]] = False
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Rectangles: Liang-Barsky line clipping, see line_intersects_rect
+            t0 = np.zeros(cand.shape)
+            t1 = np.ones(cand.shape)
+            miss = np.zeros(cand.shape, dtype=bool)
+            for (p, q) in ((-dx, x0 - l), (dx, r - x0), (-dy, y0 - t), (dy, b - y0)):
+                p = np.broadcast_to(p, cand.shape)
+                ti = q / p
+                t0 = np.where(p < 0, np.maximum(t0, ti), t0)
+                t1 = np.where(p > 0, np.minimum(t1, ti), t1)
+                miss |= (p == 0) & (q < 0)
+            t_rect = np.where(miss | (t0 > t1), np.inf, t0)
+            # Circles: see line_intersects_circ
+            ra = w / 2
+            fx, fy = x0 - (l + ra), y0 - (t + ra)
+            qa = dx*dx + dy*dy
+            qb = 2 * (dx*fx + dy*fy)
+            qc = (fx*fx + fy*fy) - ra*ra
+            disc = qb * qb - 4 * qa * qc
+            sq = np.sqrt(disc)
+            ta = (-qb - sq) / (2*qa)
+            tb = (-qb + sq) / (2*qa)
+            t_circ = np.where((ta >= 0) & (ta <= 1), ta,
+                        np.where((disc > 0) & (tb >= 0) & (tb <= 1), tb, np.inf))
+            t_circ[disc < 0] = np.inf
+        t_hit = np.where(cand, np.where(circ, t_circ, t_rect), np.inf)
+        first = t_hit.argmin(axis=1)
+        hits = []
+        for ray in xrange(num_rays):
+            k = first[ray]
+            th = t_hit[ray, k]
+            if th == np.inf:
+                hits.append(None)
+            else:
+                th = float(th)
+                hits.append((th, (float(x0[ray,0] + th*dx[ray,0]), float(y0[ray,0] + th*dy[ray,0])), objects[k]))
+        return hits
+
+    def _movable_separations(self, moved):
+        """ Computes the separations between pairs of movable objects
+            of which at least one has moved. Returns arrays with the
+            indices of both objects, the penetration distance and the
+            movement of the first object that separates them.
+        """
+        x, y, w, h = self.x, self.y, self.w, self.h
+        i, j = self.pair_i, self.pair_j
+        # Bounding box overlap
+        cand = ((moved[i] | moved[j]) &
+                (x[j] < x[i] + w[i]) & (x[i] < x[j] + w[j]) &
+                (y[j] < y[i] + h[i]) & (y[i] < y[j] + h[j]))
+        i, j = i[cand], j[cand]
+        ra = w[i] / 2
+        dx = (x[i] + ra) - (x[j] + w[j] / 2)
+        dy = (y[i] + ra) - (y[j] + h[j] / 2)
+        p, px, py, hit = _separate_circles(dx, dy, ra + w[j] / 2)
+        return (i[hit], j[hit], p[hit], px[hit], py[hit])
+
+    def _static_separations(self, moved):
+        """ Computes the separations between the movable objects that
+            have moved and all static objects. Returns arrays with the
+            index of the movable, the index of the static object, the
+            penetration distance and the movement of the movable object.
+        """
+        mi = np.flatnonzero(moved)
+        x, y, w, h = self.x[mi], self.y[mi], self.w[mi], self.h[mi]
+        # Bounding box overlap between all moved/static pairs
+        cand = ((self.s_l < (x + w)[:,None]) & (self.s_r > x[:,None]) &
+                (self.s_t < (y + h)[:,None]) & (self.s_b > y[:,None]))
+        a, k = np.nonzero(cand)
+        x, y, w, h = x[a], y[a], w[a], h[a]
+        i = mi[a]
+        ra = w / 2
+        cx = x + ra
+        cy = y + h / 2
+        l, t, r, b = self.s_l[k], self.s_t[k], self.s_r[k], self.s_b[k]
+        circ = self.s_circ[k]
+        # Circles are separated as circles, rectangles as a circle and
+        # a point if the circle is diagonally outside of a corner, and
+        # as two rectangles otherwise.
+        corner_x = np.where(cx < l, l, r)
+        corner_y = np.where(cy < t, t, b)
+        corner = ~circ & ((cx < l) | (cx > r)) & ((cy < t) | (cy > b))
+        boxes = ~circ & ~corner
+        dx = np.where(circ, cx - (l + self.s_w[k] / 2), cx - corner_x)
+        dy = np.where(circ, cy - (t + self.s_h[k] / 2), cy - corner_y)
+        md = np.where(circ, ra + self.s_w[k] / 2, ra)
+        p, px, py, hit = _separate_circles(dx, dy, md)
+        # Replace the box separations, the smallest side penetration
+        # wins, with ties going to the first side in order left, top,
+        # right, bottom.
+        sides = np.vstack((r - x, b - y, x + w - l, y + h - t))
+        side = sides.argmin(axis=0)
+        box_p = sides.min(axis=0)
+        p  = np.where(boxes, box_p, p)
+        px = np.where(boxes, box_p * ((side == 0) * 1.0 - (side == 2)), px)
+        py = np.where(boxes, box_p * ((side == 1) * 1.0 - (side == 3)), py)
+        hit |= boxes
+        return (i[hit], k[hit], p[hit], px[hit], py[hit])
+
+### HELPER FUNCTIONS ###
+
+def _separate_circles(dx, dy, md):
+    """ Separates circles whose centers are (dx, dy) apart and that
+        should be at least md apart. Returns the penetration distance,
+        the movement of the first circle, and a mask indicating which
+        pairs overlap. Values for pairs that don't overlap are undefined.
+    """
+    ds = dx*dx + dy*dy
+    hit = ds < md*md
+    # Objects that are (almost) on top of each other aren't moved.
+    close = ds < 0.01
+    d = np.sqrt(np.where(close, 1.0, ds))
+    p = np.where(close, 0.0, md - d)
+    f = p / d
+    return p, f*dx, f*dy, hit
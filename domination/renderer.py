@@ -14,6 +14,7 @@ import os
 import time
 import sys
 import math
+import subprocess
 
 # Libraries
 import pygame as pg
@@ -36,9 +37,12 @@ C_BLUE              = (81,142,221)
 SPF                 = 1/60.0 # Seconds per frame
 ROTATION_FRAMES     = 5 # Number of frames for rotation animation
 SHOOTING_FRAMES     = 10 # Number of frames for shooting animation
+ROTATION_ANGLES     = 64 # Number of pre-rotated images of each rotating sprite
 DRAW_BOUNDING_BOXES = False
 DRAW_NAV_MESH       = False
 DRAW_IDS            = False
+DIRTY_RECTS         = True # Only redraw the parts of the screen that changed
+MAX_SPEED           = 64 # Fastest playback speed, in multiples of real time
 
 ### CLASSES ###
 class Renderer(object):
@@ -47,8 +51,26 @@ class Renderer(object):
     UI_WIDTH            = 640
     
     """Renderer"""
-    def __init__(self, game, skin=''):
+    def __init__(self, game, skin='', offscreen=False, frames=None, encoder=None,
+                 speed=1, step_only=False, every=1):
+        """ Sets up the window and loads the sprites.
+        
+            :param offscreen: Render without a display and as fast as possible,
+                              for saving frames on a server. 
+            :param frames:    Save every frame as a PNG image, to this filename 
+                              pattern, e.g. ``'frames/%06d.png'``.
+            :param encoder:   Send every frame as raw RGB to the standard input of 
+                              this shell command, e.g. a video encoder. The command
+                              can contain ``{width}``, ``{height}`` and ``{fps}``.
+            :param speed:     Play faster by only drawing every n-th frame, from 1 
+                              up to MAX_SPEED. Can be changed with the +/- keys.
+            :param step_only: Only draw the end of each step, without the frames
+                              that animate the turning, shooting and driving.
+            :param every:     Only draw every n-th step.
+        """
         # Global pygame init
+        if offscreen:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
         pg.init()
         
         # Variables
@@ -56,6 +78,11 @@ class Renderer(object):
         self.render_time = 0.0
         self.paused = False
         self.active_team = 0
+        self.offscreen = offscreen
+        self.speed = max(1, min(MAX_SPEED, int(speed)))
+        self.step_only = step_only
+        self.every = max(1, int(every))
+        self.calls = 0
                 
         # Setup screen/surfaces
         field = game.field
@@ -69,7 +96,12 @@ class Renderer(object):
         ui_x = (sw - Renderer.UI_WIDTH) // 2
         self.vp_rect = [vp_x,0,fw*self.upscale, fh*self.upscale]
         # Set display mode
-        self.screen  = pg.display.set_mode((max(self.vp_rect[2],Renderer.UI_WIDTH), self.vp_rect[3] + Renderer.UI_HEIGHT))
+        size = (max(self.vp_rect[2],Renderer.UI_WIDTH), self.vp_rect[3] + Renderer.UI_HEIGHT)
+        if offscreen:
+            # The dummy driver defaults to 8 bits, which can't hold the sprites
+            self.screen = pg.display.set_mode(size, 0, 32)
+        else:
+            self.screen = pg.display.set_mode(size)
         self.ui_surf = self.screen.subsurface((ui_x,self.vp_rect[3],Renderer.UI_WIDTH, Renderer.UI_HEIGHT))
         self.vp_surf = pg.Surface((fw, fh))
         self.agent_debug = pg.Surface((fw,fh),flags=pg.SRCALPHA)
@@ -104,6 +136,13 @@ class Renderer(object):
             "ui_overlay":self.load_texture("ui-overlay.png",skin),
             "ui_background":self.load_texture("ui-background.png",skin)
         }
+        # Pre-rotate the sprites that turn
+        self.atlas = {}
+        for name in ('tank_red','tank_blue','vacubot_red','vacubot_blue'):
+            self.rotated(name, 0)
+        for name in ('muzzle','explode'):
+            for frame in xrange(len(self.ims[name])):
+                self.rotated(name, 0, frame)
         
         # Set up window
         pg.display.set_icon(self.ims['icon'])
@@ -120,6 +159,24 @@ class Renderer(object):
         self.selection_rect = None
         self.mouse_down     = False
         
+        # Frame output
+        self.frame     = 0
+        self.frames    = frames
+        self.encoder   = None
+        if frames is not None and os.path.dirname(frames) and not os.path.exists(os.path.dirname(frames)):
+            os.makedirs(os.path.dirname(frames))
+        if encoder is not None:
+            command = encoder.format(width=size[0], height=size[1], fps=int(round(1/SPF)))
+            self.encoder = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        
+        # What was drawn in the last frame
+        self.redraw         = True
+        self.sprites        = {}
+        self.selection      = None
+        self.ui_state       = None
+        self.debug_step     = None
+        self.debug_scaled   = None
+        
     def load_texture(self, name, skin=''):
         """ Looks up the tree for a sprite with the correct name,
             this allows skin packs to override only certain sprites.
@@ -129,28 +186,188 @@ class Renderer(object):
             return pg.image.load(os.path.join(path,name)).convert_alpha()
         else:
             return self.load_texture(name, os.path.split(skin)[0])
+            
+    def rotated(self, name, angle, frame=None):
+        """ Returns the sprite with the given name (and animation frame), 
+            rotated by the given angle in radians, rounded to the nearest
+            one of ROTATION_ANGLES. The rotations of each sprite are 
+            rendered once and then stored in an atlas.
+        """
+        key = name if frame is None else (name, frame)
+        rotations = self.atlas.get(key)
+        if rotations is None:
+            bmp = self.ims[name] if frame is None else self.ims[name][frame]
+            rotations = self.atlas[key] = rotate_all(bmp, ROTATION_ANGLES)
+        return rotations[rotation_index(angle)]
         
-    def render(self, game, wait = True, shooting_frame=-1):
+    def render(self, game, wait = True, shooting_frame=-1, last=False):
+        """ Draws a frame. Game.run calls this many times per step, with
+            last set for the final frame of each step. Depending on the 
+            speed settings, most calls just handle the input.
+        """
         self.handle_events(game)
-        if wait:
+        if not self.draws(game, last):
+            return
+        if wait and not self.offscreen:
             time.sleep(max(0, self.last_frame + SPF - time.clock()))
         scr             = self.screen
         vp              = self.vp_surf
-        ui              = self.ui_surf
         self.last_frame = time.clock()
-        scr.fill((71,71,71))
-        ## MAP
-        vp.blit(self.mapsurface,(0,0))
-        ## DEBUG: MESH
-        if DRAW_NAV_MESH:
-            for n1 in game.field.mesh:
-                for n2 in game.field.mesh[n1]:
-                    pg.draw.line(vp,(120,180,120),n1,n2,2)
-                pg.draw.circle(vp,(120,180,120),n1,3)
-        ## OBJECTS
-        for o in game.objects:                
-            if o.graphic is None:
-                continue
+        # Agents draw their debug once per step, so it is only scaled then
+        if game.step != self.debug_step:
+            self.debug_step = game.step
+            if self.agent_debug.get_bounding_rect().width:
+                self.debug_scaled = pg.transform.scale(self.agent_debug, (self.vp_rect[2],self.vp_rect[3]))
+                self.redraw = True
+            elif self.debug_scaled is not None:
+                self.debug_scaled = None
+                self.redraw = True
+        # Find out what every object looks like in this frame
+        sprites = {}
+        for o in game.objects:
+            if o.graphic is not None:
+                sprites[o] = self.sprite(o, shooting_frame)
+        selection = None
+        if self.selection_rect is not None and self.mouse_down:
+            selection = pg.Rect(self.selection_rect)
+            selection.normalize()
+            selection.inflate_ip(4, 4)
+        # Redraw only the parts of the viewport that changed
+        dirty = None
+        if DIRTY_RECTS and not (self.redraw or DRAW_NAV_MESH or DRAW_BOUNDING_BOXES or DRAW_IDS):
+            dirty = self.dirty_rects(sprites, selection)
+        self.sprites, self.selection = sprites, selection
+        if dirty is None:
+            self.redraw = False
+            scr.fill((71,71,71))
+            vp.blit(self.mapsurface,(0,0))
+            ## DEBUG: MESH
+            if DRAW_NAV_MESH:
+                mesh = game.field.mesh
+                for i, n1 in enumerate(mesh.nodes):
+                    for (_, j, _) in mesh.edges(i):
+                        pg.draw.line(vp,(120,180,120),n1,mesh.nodes[j],2)
+                    pg.draw.circle(vp,(120,180,120),n1,3)
+            self.draw_objects(game, [o for o in game.objects if o in sprites], shooting_frame)
+            scr.blit(pg.transform.scale(vp, (self.vp_rect[2],self.vp_rect[3])), dest=(self.vp_rect[0],0))
+            # Blit the agent's debug
+            if self.debug_scaled is not None:
+                scr.blit(self.debug_scaled, dest=(self.vp_rect[0],self.vp_rect[1]))
+            self.draw_ui(game, force=True)
+            pg.display.flip()
+        else:
+            updated = []
+            for r in dirty:
+                # Restore the map and draw the objects that overlap
+                vp.set_clip(r)
+                vp.blit(self.mapsurface, r, area=r)
+                objects = [o for o in game.objects if o in sprites and r.colliderect(sprites[o][1])]
+                self.draw_objects(game, objects, shooting_frame)
+                vp.set_clip(None)
+                # Scale the rect to the screen
+                up = self.upscale
+                dest = pg.Rect(self.vp_rect[0] + r.x*up, self.vp_rect[1] + r.y*up, r.width*up, r.height*up)
+                if up == 1:
+                    scr.blit(vp, dest, area=r)
+                else:
+                    scr.blit(pg.transform.scale(vp.subsurface(r), dest.size), dest)
+                if self.debug_scaled is not None:
+                    scr.blit(self.debug_scaled, dest, area=(r.x*up, r.y*up, dest.width, dest.height))
+                updated.append(dest)
+            if self.draw_ui(game):
+                updated.append(pg.Rect(self.ui_surf.get_abs_offset(), self.ui_surf.get_size()))
+            pg.display.update(updated)
+        # Save the frame
+        if self.frames is not None:
+            pg.image.save(scr, self.frames % self.frame)
+        if self.encoder is not None:
+            self.encoder.stdin.write(pg.image.tostring(scr, 'RGB'))
+        self.frame += 1
+        # Compute render time
+        self.render_time = time.clock() - self.last_frame
+        
+    def draws(self, game, last=False):
+        """ Whether a frame should be drawn. """
+        if self.paused:
+            return True
+        if game.step % self.every != 0:
+            return False
+        if self.step_only or last:
+            return last
+        self.calls += 1
+        return self.calls % self.speed == 0
+        
+    def sprite(self, o, shooting_frame=-1):
+        """ Returns what an object looks like in the current frame,
+            as a tuple that can be compared to the previous frame, and
+            the rect on the viewport that it covers.
+        """
+        bmp        = self.ims[o.graphic]
+        dstx, dsty = int(o._x), int(o._y)
+        w, h       = int(o.width), int(o.height)
+        angle      = None
+        if o._a != 0:
+            angle = rotation_index(o._a)
+            (ocx,ocy) = bmp.get_rect().center
+            bmp = self.rotated(o.graphic, o._a)
+            (ncx,ncy) = bmp.get_rect().center
+            rect = pg.Rect(dstx - ncx + ocx, dsty - ncy + ocy, bmp.get_width(), bmp.get_height())
+        else:
+            rect = pg.Rect(dstx, dsty, w, h)
+        selected = getattr(o, 'selected', False)
+        if selected:
+            rect.union_ip((dstx-4, dsty-4, w+8, h+8))
+        shot = None
+        if shooting_frame >= 0 and hasattr(o,'shoots'):
+            exploding = o.respawn_in == o.game.settings.spawn_time
+            if o.shoots:
+                cx,cy = int(o._x + o.width/2), int(o._y + o.height/2)
+                hx,hy = int(o._hitx), int(o._hity)
+                rect.union_ip((min(cx,hx)-1, min(cy,hy)-1, abs(hx-cx)+3, abs(hy-cy)+3))
+                if shooting_frame < len(self.ims['muzzle']):
+                    sbmp = self.rotated('muzzle', o._a, shooting_frame)
+                    (ncx,ncy) = sbmp.get_rect().center
+                    rect.union_ip((cx - ncx, cy - ncy, sbmp.get_width(), sbmp.get_height()))
+                shot = (shooting_frame, hx, hy, exploding)
+            if exploding:
+                xbmp = self.rotated('explode', o._a, shooting_frame)
+                rect.union_ip((dstx, dsty, xbmp.get_width(), xbmp.get_height()))
+                shot = (shooting_frame, shot, exploding)
+        return ((o.graphic, dstx, dsty, w, h, angle, selected, shot), rect)
+        
+    def dirty_rects(self, sprites, selection):
+        """ Returns the rects of the viewport where objects appeared, 
+            disappeared or changed since the last frame, or None if
+            it is quicker to redraw everything.
+        """
+        last  = self.sprites
+        dirty = []
+        for o, (state, rect) in sprites.iteritems():
+            if o not in last:
+                dirty.append(rect)
+            elif last[o][0] != state:
+                if rect.colliderect(last[o][1]):
+                    dirty.append(rect.union(last[o][1]))
+                else:
+                    dirty.append(rect)
+                    dirty.append(last[o][1])
+        for o in last:
+            if o not in sprites:
+                dirty.append(last[o][1])
+        if selection != self.selection:
+            dirty.extend(r for r in (selection, self.selection) if r is not None)
+        # Clip to the viewport
+        bounds = self.vp_surf.get_rect()
+        dirty = [r.clip(bounds) for r in dirty]
+        dirty = [r for r in dirty if r.width and r.height]
+        if sum(r.width * r.height for r in dirty) > bounds.width * bounds.height // 2:
+            return None
+        return dirty
+        
+    def draw_objects(self, game, objects, shooting_frame=-1):
+        """ Draws the given objects (in order) on the viewport. """
+        vp = self.vp_surf
+        for o in objects:
             bmp        = self.ims[o.graphic]
             dstx, dsty = int(o._x), int(o._y)
             w, h       = int(o.width), int(o.height)
@@ -158,21 +375,12 @@ class Renderer(object):
             # Render a rotated sprite
             if o._a != 0:
                 (ocx,ocy) = bmp.get_rect().center
-                degs      = -o._a*rad_to_deg
-                # Use quick rotate for (almost) aligned sprites.
-                if degs % 90 < 0.1:
-                    bmp       = pg.transform.rotate(bmp,-o._a*rad_to_deg)
-                else:
-                    bmp       = pg.transform.rotozoom(bmp,-o._a*rad_to_deg,1)
+                bmp       = self.rotated(o.graphic, o._a)
                 (ncx,ncy) = bmp.get_rect().center
                 dstx -= ncx - ocx
                 dsty -= ncy - ocy
                 w,h = bmp.get_rect().size
                 vp.blit(bmp, dest=(dstx,dsty), area=(0,0,w,h))            
-            # Render rotated sprite using pre-rotated frames
-            # if o._a != 0:
-            #     frame = int((0.5 + 4*o._a/pi) % 8) 
-            #     scr.blit(bmp, dest=(dstx,dsty), area=(w*frame,0,w,h))
             # Render fill sprite
             elif w > bmpw or h > bmph:
                 tile_fill(vp, bmp, rect=(dstx,dsty,w,h))
@@ -183,15 +391,17 @@ class Renderer(object):
             if shooting_frame >= 0 and hasattr(o,'shoots'):
                 if o.shoots:
                     cx,cy = int(o._x + o.width/2), int(o._y + o.height/2)
+                    # Clipping moves the pixels of a line, so draw it whole
+                    clip = vp.get_clip()
+                    vp.set_clip(None)
                     pg.draw.line(vp, (98,83,93), (cx, cy), (o._hitx, o._hity),1)
+                    vp.set_clip(clip)
                     if shooting_frame < len(self.ims['muzzle']):
-                        sbmp = self.ims['muzzle'][shooting_frame]
-                        sbmp = pg.transform.rotate(sbmp, -o._a*rad_to_deg)
+                        sbmp = self.rotated('muzzle', o._a, shooting_frame)
                         (ncx,ncy) = sbmp.get_rect().center
                         vp.blit(sbmp, dest=(cx - ncx,cy - ncy))
                 if o.respawn_in == o.game.settings.spawn_time:
-                    xbmp = self.ims['explode'][shooting_frame]
-                    xbmp = pg.transform.rotate(xbmp, -o._a*rad_to_deg)
+                    xbmp = self.rotated('explode', o._a, shooting_frame)
                     vp.blit(xbmp, dest=(dstx,dsty))
             if DRAW_BOUNDING_BOXES:
                 if o.shape == 0: #rect
@@ -203,17 +413,23 @@ class Renderer(object):
                 vp.blit(txt, dest=(dstx-txt.get_width(), dsty-txt.get_height()))
         
         # Selection/Overlay
-        for t in game.tanks:
-            if t.selected:
+        for t in objects:
+            if getattr(t, 'selected', False):
                 pg.draw.rect(vp, (255,255,255), (t._x-2, t._y-2, t.width+4, t.height+4), 2)
         if self.selection_rect is not None and self.mouse_down:
             pg.draw.rect(vp, (255,255,255), self.selection_rect, 2)
-        scr.blit(pg.transform.scale(vp, (self.vp_rect[2],self.vp_rect[3])), dest=(self.vp_rect[0],0))
-        
-        # Blit the agent's debug
-        scr.blit(pg.transform.scale(self.agent_debug, (self.vp_rect[2],self.vp_rect[3])), dest=(self.vp_rect[0],self.vp_rect[1]))
-        
-        ## INTERFACE
+            
+    def draw_ui(self, game, force=False):
+        """ Draws the interface, if anything on it changed since the 
+            last frame, or if force is set. Returns whether it was drawn.
+        """
+        ui = self.ui_surf
+        state = (game.score_red, game.score_blue, game.step, game.think_time_red, 
+                 game.think_time_blue, self.active_team, game.replay is not None, game.record,
+                 self.speed)
+        if state == self.ui_state and not force:
+            return False
+        self.ui_state = state
         # Scores/Remaining time
         ui.blit(self.ims['ui_background'],dest=(0,0))
         ms = game.settings.max_score
@@ -259,6 +475,8 @@ class Renderer(object):
             m = "Replay"
         elif game.record:
             m = "Recording"
+        if self.speed > 1:
+            m += " %dx"%(self.speed)
         txt = self.font.render(m,False,(255,255,255))
         ui.blit(txt, dest=(120, 39))
         # Render time
@@ -275,11 +493,7 @@ class Renderer(object):
         # self.substep_stats.fill((0,0,0),(59,0,1,30))
         # self.substep_stats.fill((0,255,0),(59,15-int(game.sim_time*200),1,1))
         # ui.blit(self.substep_stats, dest=(440,16))
-        
-        # Flip buffers
-        pg.display.flip()
-        # Compute render time
-        self.render_time = time.clock() - self.last_frame
+        return True
 
     def handle_events(self, game):
         for event in pg.event.get():
@@ -322,11 +536,17 @@ class Renderer(object):
                 if event.key == pg.K_SPACE:
                     self.paused = not self.paused
                     self.pause_loop(game)
+                elif event.key in (pg.K_PLUS, pg.K_EQUALS, pg.K_KP_PLUS):
+                    self.speed = min(MAX_SPEED, self.speed * 2)
+                elif event.key in (pg.K_MINUS, pg.K_KP_MINUS):
+                    self.speed = max(1, self.speed // 2)
                 elif 97 <= event.key <= 122:
                     game._keypress(event.key)
                     
     def toggle_team(self,game):
         self.agent_debug.fill((0,0,0,0))
+        self.debug_scaled = None
+        self.redraw = True
         self.active_team = 1-self.active_team
         game._select_tanks((0,0,0,0),team=self.active_team)
         
@@ -336,6 +556,10 @@ class Renderer(object):
             self.handle_events(game)
             
     def quit(self):
+        if self.encoder is not None:
+            self.encoder.stdin.close()
+            self.encoder.wait()
+            self.encoder = None
         pg.display.quit()
         
 ### HELPER FUNCTIONS ###
@@ -350,6 +574,26 @@ def tile_fill(surface, bitmap, rect=None, area=None):
             a = (bx,by,min(bw, sx+sw-x),min(bh, sy+sh-y))
             surface.blit(bitmap, dest=(x,y), area=a)
 
+def rotation_index(angle):
+    """ Returns the index of the pre-rotated sprite that is
+        closest to the given angle (in radians).
+    """
+    return int(round(-angle * rad_to_deg * ROTATION_ANGLES / 360.0)) % ROTATION_ANGLES
+
+def rotate_all(bitmap, n):
+    """ Returns a list of n copies of bitmap, rotated
+        counterclockwise in steps of 360/n degrees.
+    """
+    rotations = []
+    for i in xrange(n):
+        degs = i * 360.0 / n
+        # Use quick rotate for aligned sprites.
+        if degs % 90 == 0:
+            rotations.append(pg.transform.rotate(bitmap, degs))
+        else:
+            rotations.append(pg.transform.rotozoom(bitmap, degs, 1))
+    return rotations
+
 def draw_tilemap(surface, tiles, graphic, tilesize):
     """ Draws a tilemap using the autotile algorithm. """
     T,R,B,L = 1,2,4,8;
@@ -19,6 +19,11 @@ import hashlib
 import copy
 import uuid
 import shutil
+import gzip
+import zlib
+import mmap
+import struct
+from cStringIO import StringIO
 from collections import defaultdict
 
 # Local
@@ -32,6 +37,10 @@ pi = math.pi
 SCORING_LINEAR = 'linear'
 SCORING_CONSTANT = 'constant'
 
+#: Columns of the index that is written next to a replays.zip
+INDEX_FIELDS = ('game', 'replay', 'red_file', 'blue_file', 'score_red', 'score_blue', 
+                'steps', 'offset', 'size', 'compress_type')
+
 
 ### FUNCTIONS ###
 
@@ -41,6 +50,175 @@ def callfunc(tup):
     (ob, fun, args, kwds) = tup
     return getattr(ob, fun)(*args, **kwds)
 
+def replay_sources(path):
+    """ Lists the replays in a replays.zip written by a :class:`Scenario`,
+        a folder of replays (e.g. downloaded from the web app), or a
+        single replay file, as ``(path, member)`` tuples. The member is the
+        name inside the zip file, or None.
+    """
+    if os.path.isdir(path):
+        files = glob.glob(os.path.join(path, '*.pickle')) + glob.glob(os.path.join(path, '*.gz'))
+        return [(f, None) for f in sorted(files)]
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zipf:
+            names = zipf.namelist()
+        return [(path, n) for n in sorted(names) if n.endswith('.pickle') or n.endswith('.gz')]
+    return [(path, None)]
+    
+def load_replay(path, member=None):
+    """ Loads a single replay, given one of the tuples from 
+        :func:`replay_sources`. Replays may be gzipped.
+    """
+    if member is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = path
+    else:
+        with zipfile.ZipFile(path) as zipf:
+            data = zipf.read(member)
+        name = member
+    if name.endswith('.gz'):
+        data = gzip.GzipFile(fileobj=StringIO(data)).read()
+    return pickle.loads(data)
+    
+def verify_replay(path, member=None, stored=None):
+    """ Simulates a replay again without rendering, and returns a dict
+        with its :class:`~domination.core.GameStats`, some derived metrics, 
+        and whether the score matches the one that was stored with the 
+        replay (or the given stored stats, as a dict). 
+    """
+    row = {'replay': member or path, 'error': '', 'mismatch': ''}
+    try:
+        replay = load_replay(path, member)
+        if getattr(replay, 'stats', None) is not None:
+            stored = replay.stats.__dict__
+        game = core.Game(replay=replay, rendered=False, verbose=False)
+        game.run()
+    except Exception, e:
+        row['error'] = repr(e)
+        return row
+    stats = game.stats
+    row.update(stats.__dict__)
+    row['red_name'] = replay.red_name
+    row['blue_name'] = replay.blue_name
+    if abs(stats.score - 0.5) < Scenario.DRAW_MARGIN:
+        row['winner'] = 'draw'
+    else:
+        row['winner'] = 'red' if stats.score > 0.5 else 'blue'
+    row['kills_red'] = stats.deaths_blue
+    row['kills_blue'] = stats.deaths_red
+    if stored is not None:
+        row['stored_score_red'] = int(stored['score_red'])
+        row['stored_score_blue'] = int(stored['score_blue'])
+        row['mismatch'] = (row['stored_score_red'], row['stored_score_blue']) != (stats.score_red, stats.score_blue)
+    return row
+    
+def index_path(path):
+    """ Returns the path of the index file of a replays.zip """
+    return os.path.splitext(path)[0] + '_index.csv'
+
+def write_replay_index(path, games=None):
+    """ Writes an index file next to a replays.zip (see :class:`ReplayArchive`).
+        It contains the game number, the agents, the scores and the length of 
+        each game, and where its replay is stored in the archive.
+        
+        :param path:  Path to the zip file.
+        :param games: A dict from names in the archive to dicts with the other 
+                      :data:`INDEX_FIELDS`. If they are missing, only what is in 
+                      the names is indexed.
+    """
+    rows = _index_rows(path, games)
+    with open(index_path(path), 'wb') as f:
+        csvf = csv.DictWriter(f, INDEX_FIELDS, extrasaction='ignore')
+        csvf.writerow(dict(zip(INDEX_FIELDS, INDEX_FIELDS)))
+        csvf.writerows(rows)
+    
+def agent_name(path):
+    """ The name of an agent file in the index of a replays.zip, the
+        base name without extension, like in the names of the replays.
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+    
+def _index_rows(path, games=None):
+    """ Returns the rows of the index of a replays.zip, 
+        see :func:`write_replay_index`.
+    """
+    games = games or {}
+    with zipfile.ZipFile(path) as zipf:
+        infos = zipf.infolist()
+    rows = []
+    with open(path, 'rb') as f:
+        for info in infos:
+            row = {'replay': info.filename}
+            # The name is replay_0000_red_vs_blue.pickle
+            parts = os.path.splitext(info.filename)[0].split('_', 2)
+            if len(parts) == 3 and parts[1].isdigit() and '_vs_' in parts[2]:
+                row['game'] = int(parts[1])
+                row['red_file'], row['blue_file'] = parts[2].split('_vs_', 1)
+            row.update(games.get(info.filename, {}))
+            # The data starts after the local header, which can differ from the central one
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            row['offset'] = info.header_offset + 30 + name_len + extra_len
+            row['size'] = info.compress_size
+            row['compress_type'] = info.compress_type
+            rows.append(row)
+    return rows
+    
+def _verify_replay(args):
+    """ Unpacks the arguments for Pool.map """
+    return verify_replay(*args)
+
+def verify_replays(paths, output=None, processes=None):
+    """ Simulates many replays again, in parallel, to check if their
+        scores match the stored ones, and writes the results to a CSV
+        file. Replays without stored stats that come from a replays.zip 
+        are compared to the games.csv next to it.
+        
+        :param paths:     Replay files, folders or archives (see :func:`replay_sources`).
+        :param output:    Path of the CSV file to write.
+        :param processes: Number of processes to use, defaults to the number of CPUs.
+        
+        :returns: A list of rows (dicts), one per replay.
+    """
+    jobs = []
+    for path in paths:
+        sources = replay_sources(path)
+        # Scores written by Scenario._write, in the order of the replays
+        games = []
+        csvpath = os.path.join(os.path.dirname(path), 'games.csv')
+        if zipfile.is_zipfile(path) and os.path.exists(csvpath):
+            with open(csvpath) as f:
+                games = list(csv.DictReader(f))
+        for (p, member) in sources:
+            stored = None
+            if member is not None and member.startswith('replay_'):
+                i = int(member.split('_')[1])
+                if i < len(games):
+                    stored = games[i]
+            jobs.append((p, member, stored))
+    try:
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        rows = pool.map(_verify_replay, jobs, chunksize=1)
+        pool.close()
+    except ImportError:
+        rows = map(_verify_replay, jobs)
+    for row in rows:
+        if row['mismatch'] or row['error']:
+            print "Replay %s does not match: %s" % (row['replay'], row['error'] or 
+                  '%(score_red)d - %(score_blue)d, stored %(stored_score_red)d - %(stored_score_blue)d' % row)
+    if output is not None:
+        fieldnames = (['replay', 'red_name', 'blue_name'] + sorted(core.GameStats().__dict__) + 
+                      ['winner', 'kills_red', 'kills_blue', 'stored_score_red', 'stored_score_blue', 
+                       'mismatch', 'error'])
+        with open(output, 'wb') as f:
+            csvf = csv.DictWriter(f, fieldnames, extrasaction='ignore')
+            csvf.writerow(dict(zip(fieldnames, fieldnames)))
+            csvf.writerows(rows)
+    return rows
+
 ### CLASSES ###
 
 class MatchInfo(object):
@@ -75,6 +253,9 @@ class Scenario(object):
     SWAP_TEAMS        = True   #: Repeat each run with blue/red swapped
     DRAW_MARGIN       = 0.05
     SCORING           = SCORING_LINEAR
+    TELEMETRY         = False  #: Write the per-step telemetry of each game to telemetry.zip
+    LOG_KBS           = 32     #: Keep this much of the end of each game log for logs.zip
+    LOG_RATE_KBS      = None   #: How much each agent may print per step, None for no limit
 
     MULTITHREADING = True
             
@@ -125,10 +306,13 @@ class Scenario(object):
         game = core.Game(red, blue, 
                     red_init=red_init, blue_init=blue_init,
                     field=self.FIELD, settings=self.SETTINGS,
-                    record=True, verbose=verbose, rendered=False)
+                    record=True, verbose=verbose, rendered=False,
+                    telemetry=self.TELEMETRY,
+                    log=core.GameLog(verbose, max_kbs=self.LOG_KBS, rate_kbs=self.LOG_RATE_KBS))
         if rendered:
             game.add_renderer()
         game.run()
+        arrays = game.telemetry.arrays() if game.telemetry is not None else None
         # Close the blobs
         if 'blob' in red_init:
             red_init['blob'].close()
@@ -136,7 +320,7 @@ class Scenario(object):
             blue_init['blob'].close()
         self.after_game(game)
         print game.stats
-        return (matchinfo, game.stats, game.replay, game.log)
+        return (matchinfo, game.stats, game.replay, game.log, arrays)
 
     def _match(self, red, blue, output_folder, rendered, verbose):
         """ Runs a single match consisting of multiple games 
@@ -215,13 +399,19 @@ class Scenario(object):
         zipf = zipfile.ZipFile(os.path.join(output_folder, 'replays.zip'),'w', zipfile.ZIP_DEFLATED, True)
         logs = zipfile.ZipFile(os.path.join(output_folder, 'logs.zip'),'w', zipfile.ZIP_DEFLATED, True)
         sf = open(os.path.join(output_folder, 'summary.md'),'w')
+        tel = None
+        if any(g[6] is not None for g in gameinfo):
+            import telemetry
+            # The arrays are compressed already
+            tel = zipfile.ZipFile(os.path.join(output_folder, 'telemetry.zip'),'w', zipfile.ZIP_STORED, True)
         sf.write('In total, %d games were played.\n\n' % len(gameinfo))
         
         by_color = defaultdict(lambda: [0., 0.])
         by_match = defaultdict(lambda: [0., 0.])
         by_team = defaultdict(lambda: 0.)
+        index = {}
         
-        for i, (r, b, matchinfo, stats, replay, log) in enumerate(gameinfo):
+        for i, (r, b, matchinfo, stats, replay, log, arrays) in enumerate(gameinfo):
             r = r[prefix:]
             b = b[prefix:]
             
@@ -255,8 +445,16 @@ class Scenario(object):
             csvf.writerow(s)
             rbase = os.path.splitext(os.path.basename(r))[0]
             bbase = os.path.splitext(os.path.basename(b))[0]
-            zipf.writestr('replay_%04d_%s_vs_%s.pickle'%(i, rbase, bbase), pickle.dumps(replay, pickle.HIGHEST_PROTOCOL))
-            logs.writestr('log_%04d_%s_vs_%s.txt'%(i, rbase, bbase), log.truncated(kbs=32))
+            name = 'replay_%04d_%s_vs_%s.pickle'%(i, rbase, bbase)
+            # Telemetry is stored next to the replay
+            if arrays is not None:
+                data = StringIO()
+                telemetry.save(data, arrays)
+                tel.writestr('telemetry_%04d_%s_vs_%s.npz'%(i, rbase, bbase), data.getvalue())
+            zipf.writestr(name, pickle.dumps(replay, pickle.HIGHEST_PROTOCOL))
+            index[name] = {'game': i, 'red_file': rbase, 'blue_file': bbase, 'score_red': stats.score_red,
+                           'score_blue': stats.score_blue, 'steps': stats.steps}
+            logs.writestr('log_%04d_%s_vs_%s.txt'%(i, rbase, bbase), log.truncated(kbs=self.LOG_KBS))
             
         
         # Put the matches into a matchup matrix (team a on left, team b on top)
@@ -281,7 +479,10 @@ class Scenario(object):
         # Close all files
         zipf.close()
         logs.close()
+        if tel is not None:
+            tel.close()
         sf.close()
+        write_replay_index(os.path.join(output_folder, 'replays.zip'), index)
         
     
     @classmethod
@@ -332,6 +533,106 @@ class Scenario(object):
         scenario._multi(matchups, output_folder=output_folder, rendered=rendered, verbose=verbose)
         
 
+class ReplayArchive(object):
+    """ Reads single replays from a replays.zip, using the index file
+        that :class:`Scenario` writes next to it, so that finding a game 
+        doesn't require listing or unpickling the whole archive::
+        
+            with ReplayArchive('results/replays.zip') as archive:
+                for game in archive.find(red='agent_one.py'):
+                    print game['blue_file'], game['score_red'], game['score_blue']
+                    replay = archive.load(game)
+        
+        The replays are read from a memory map of the archive, if possible. 
+        Archives without an index are indexed (in memory) when they are opened, 
+        use :func:`write_replay_index` to store it.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(index_path(path)):
+            with open(index_path(path), 'rb') as f:
+                rows = list(csv.DictReader(f))
+        else:
+            rows = _index_rows(path)
+        ints = ('game', 'score_red', 'score_blue', 'steps', 'offset', 'size', 'compress_type')
+        for row in rows:
+            for k in ints:
+                row[k] = int(row[k]) if row.get(k) not in (None, '') else None
+            # Older indexes stored the paths of the agents
+            for k in ('red_file', 'blue_file'):
+                if row.get(k):
+                    row[k] = agent_name(row[k])
+        #: The index, a list of dicts with the :data:`INDEX_FIELDS` of each game
+        self.games = rows
+        self._by_game = dict((row['game'], row) for row in rows if row['game'] is not None)
+        self._file = None
+        self._map = None
+        
+    def find(self, red=None, blue=None, agent=None):
+        """ Returns the index entries of the games with the given red 
+            and/or blue agent file, or with the given agent on either side.
+            Agents are compared by :func:`agent_name`, so ``'agent_one'``,
+            ``'agent_one.py'`` and ``'agents/agent_one.py'`` are the same.
+        """
+        red, blue, agent = [(None if a is None else agent_name(a)) for a in (red, blue, agent)]
+        return [g for g in self.games 
+                if (red is None or g['red_file'] == red) and
+                   (blue is None or g['blue_file'] == blue) and
+                   (agent is None or agent in (g['red_file'], g['blue_file']))]
+        
+    def read(self, game):
+        """ Returns the pickled replay of a game (an index entry or a game
+            number), as a string.
+        """
+        if not isinstance(game, dict):
+            game = self._by_game[game]
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+            try:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError, OverflowError):
+                self._map = None
+        start, end = game['offset'], game['offset'] + game['size']
+        if self._map is not None:
+            data = self._map[start:end]
+        else:
+            self._file.seek(start)
+            data = self._file.read(end - start)
+        if game['compress_type'] == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        elif game['compress_type'] == zipfile.ZIP_STORED:
+            return data
+        with zipfile.ZipFile(self.path) as zipf:
+            return zipf.read(game['replay'])
+        
+    def load(self, game):
+        """ Loads the replay of a game (an index entry or a game number). """
+        return pickle.loads(self.read(game))
+        
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+        self._file = self._map = None
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *exc_info):
+        self.close()
+        
+    def __len__(self):
+        return len(self.games)
+        
+    def __iter__(self):
+        return iter(self.games)
+        
+    def __getitem__(self, game):
+        return self.load(game)
+
+
 ### HELPER FUNCTIONS ###
 
 def markdown_table(body, header=None):
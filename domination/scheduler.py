@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+""" Runs many games interleaved in a single process.
+
+Agents that get their actions from somewhere else, like a model server
+on the same machine, would spend most of a game waiting in ``action()``.
+Instead, they can define ``action_async()``, which sends the request and
+returns something like a :class:`concurrent.futures.Future` right away.
+A :class:`GameScheduler` then steps every game whose actions are done,
+so hundreds of games can keep a single server busy::
+
+    class Agent(object):
+        def action_async(self):
+            return client.submit(self.observation)   # Returns a future
+        ...
+
+    games = [core.Game(red, blue, rendered=False, verbose=False) for _ in range(200)]
+    scheduler.GameScheduler(games, poll=client.flush).run()
+
+Each game writes what its agents print to its own log. Agents that only
+have ``action()`` still work, their games just don't wait for anything.
+Actions that aren't done within ``Settings.async_timeout``, or whose
+``done()`` raises an exception, are replaced by the default action. Only
+the time spent in ``action_async()`` and ``done()`` counts as think time.
+
+"""
+__author__ = "Thomas van den Berg and Tim Doolan"
+
+### IMPORTS ###
+# Python
+import time
+
+### CLASSES ###
+
+class GameScheduler(object):
+    """ Interleaves the steps of multiple games, see the module docs.
+    """
+
+    def __init__(self, games=(), poll=None, interval=0.001):
+        """ Constructor for GameScheduler
+
+            :param games:    The instances of :class:`~domination.core.Game` to run.
+            :param poll:     Function that is called after every pass over the games,
+                               e.g. to send the requests of all games in one batch.
+                               If no game could be stepped, it should wait for results.
+            :param interval: Time in seconds to sleep when no game could be
+                               stepped, if there is no poll function.
+        """
+        self.poll = poll
+        self.interval = interval
+        self.running = [] # [game, generator, tanks waiting for actions]
+        self.finished = [] #: The games that have ended, in the order they ended
+        for game in games:
+            self.add(game)
+
+    def add(self, game):
+        """ Adds a game, it is started on the next :meth:`step`. """
+        self.running.append([game, game._run(), []])
+
+    def step(self):
+        """ Steps all games that aren't waiting for actions, and returns
+            whether any game was stepped.
+        """
+        stepped = False
+        for entry in self.running[:]:
+            game, steps, waiting = entry
+            if game._poll_actions(waiting):
+                stepped = True
+                try:
+                    entry[2] = steps.next()
+                except StopIteration:
+                    self.running.remove(entry)
+                    self.finished.append(game)
+        if self.poll is not None:
+            self.poll()
+        return stepped
+
+    def run(self):
+        """ Runs until all games have ended, and returns them. """
+        while self.running:
+            if not self.step() and self.poll is None:
+                time.sleep(self.interval)
+        return self.finished
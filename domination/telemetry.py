@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+""" Per-step telemetry for the domination game engine.
+
+This module records what happens during a game in fixed-size NumPy
+arrays, one row per step, so that games can be analyzed without
+re-simulating their replays. It is used by :class:`~domination.core.Game`
+when it is created with ``telemetry=True``; the recorder is then
+available as ``game.telemetry``::
+
+    game = core.Game('agent.py', 'agent.py', telemetry=True, rendered=False)
+    game.run()
+    game.telemetry.save('game.npz')
+
+    data = telemetry.load('game.npz')
+    data['score_red']           # The score of red in each step
+    data['x'][:, data['team'] == core.TEAM_BLUE]   # Positions of the blue tanks
+
+Without ``telemetry=True``, this module isn't imported at all.
+
+"""
+__author__ = "Thomas van den Berg and Tim Doolan"
+
+### IMPORTS ###
+# Libraries
+import numpy as np
+
+### CONSTANTS ###
+
+#: The per-step arrays, with their type and whether they have a value
+#: per tank, per controlpoint, or just one per step.
+COLUMNS = (('step',        np.int32,   None),   # Step number, starting at 1
+           ('score_red',   np.int32,   None),
+           ('score_blue',  np.int32,   None),
+           ('ammo_red',    np.int16,   None),   # Ammo packs picked up by red since the previous step
+           ('ammo_blue',   np.int16,   None),
+           ('cps',         np.int8,    'cps'),  # Team that holds each controlpoint
+           ('x',           np.float32, 'tanks'),
+           ('y',           np.float32, 'tanks'),
+           ('angle',       np.float32, 'tanks'),
+           ('alive',       np.bool_,   'tanks'), # Tank can move, i.e. isn't respawning
+           ('ammo',        np.int16,   'tanks'),
+           ('shoots',      np.bool_,   'tanks'),
+           ('hit',         np.int8,    'tanks'), # Team of the tank that was hit, or -1
+           ('killed',      np.bool_,   'tanks'))
+
+### CLASSES ###
+
+class Telemetry(object):
+    """ Records the state of a game after each step.
+
+        All arrays are allocated for ``settings.max_steps`` steps when the
+        game is set up, and filled in place by :meth:`update`. The
+        state is recorded at the end of each step, after the shots have 
+        been resolved and the tanks have moved and picked up ammo, so the
+        positions are the ones that the agents observe in the next step.
+        The tanks are in the order of ``game.tanks``, and the static 
+        ``team`` array holds their teams.
+    """
+
+    def __init__(self, game):
+        self.game = game
+        #: Number of steps recorded so far
+        self.steps = 0
+        #: The team of each tank
+        self.team = np.array([t.team for t in game.tanks], np.int8)
+        sizes = {None: (), 'cps': (len(game.controlpoints),), 'tanks': (len(game.tanks),)}
+        self.columns = {}
+        for name, dtype, size in COLUMNS:
+            self.columns[name] = np.zeros((game.settings.max_steps,) + sizes[size], dtype)
+        self._ammo_red = self._ammo_blue = 0
+
+    def update(self):
+        """ Records the current step. """
+        game = self.game
+        c, s = self.columns, self.steps
+        stats = game.stats
+        spawn_time = game.settings.spawn_time
+        c['step'][s] = game.step
+        c['score_red'][s] = game.score_red
+        c['score_blue'][s] = game.score_blue
+        c['ammo_red'][s] = stats.ammo_red - self._ammo_red
+        c['ammo_blue'][s] = stats.ammo_blue - self._ammo_blue
+        self._ammo_red, self._ammo_blue = stats.ammo_red, stats.ammo_blue
+        c['cps'][s] = [cp.team for cp in game.controlpoints]
+        tanks = game.tanks
+        c['x'][s] = [t.x for t in tanks]
+        c['y'][s] = [t.y for t in tanks]
+        c['angle'][s] = [t.angle for t in tanks]
+        c['alive'][s] = [t.respawn_in < 0 for t in tanks]
+        c['ammo'][s] = [t.ammo for t in tanks]
+        c['shoots'][s] = [t.shoots for t in tanks]
+        c['hit'][s] = [-1 if t.hit is None else t.hit for t in tanks]
+        c['killed'][s] = [t.respawn_in == spawn_time for t in tanks]
+        self.steps = s + 1
+
+    def arrays(self):
+        """ Returns a dictionary with the arrays, trimmed to the steps that
+            were recorded, and the static ``team`` array.
+        """
+        arrays = dict((name, column[:self.steps]) for (name, column) in self.columns.iteritems())
+        arrays['team'] = self.team
+        return arrays
+
+    def save(self, path):
+        """ Writes the arrays to a compressed ``.npz`` file, which can be
+            read with :func:`load`. Path can also be a file-like object.
+        """
+        save(path, self.arrays())
+
+### FUNCTIONS ###
+
+def save(path, arrays):
+    """ Writes a dictionary of arrays, as returned by :meth:`Telemetry.arrays`,
+        to a compressed ``.npz`` file.
+    """
+    np.savez_compressed(path, **arrays)
+
+def load(path):
+    """ Reads a file written by :meth:`Telemetry.save`, and returns
+        a dictionary with its arrays.
+    """
+    npz = np.load(path)
+    try:
+        return dict((name, npz[name]) for name in npz.files)
+    finally:
+        npz.close()
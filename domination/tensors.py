@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+""" Array observations for the domination game engine.
+
+This module fills fixed-shape NumPy arrays with what the tanks observe,
+so that learning agents can feed them to a (batched) policy directly,
+instead of converting the lists in their observations every step. It is
+used by :class:`~domination.core.Game` when the settings select
+:data:`~domination.core.OBSERVATION_ARRAYS`. Agents find their arrays
+in :attr:`Observation.spatial <domination.core.Observation>` and
+:attr:`Observation.features <domination.core.Observation>`.
+
+"""
+__author__ = "Thomas van den Berg and Tim Doolan"
+
+### IMPORTS ###
+# Libraries
+import numpy as np
+
+# Local
+from core import TEAM_RED, TEAM_BLUE, TEAM_NEUTRAL, Ammo
+
+### CONSTANTS ###
+
+# Channels of the spatial arrays.
+CHANNEL_WALLS       = 0 #: Walls, and everything outside the field
+CHANNEL_FRIENDS     = 1 #: Number of friendly tanks on each tile, excluding the observer
+CHANNEL_FOES        = 2 #: Number of enemy tanks on each tile
+CHANNEL_AMMO        = 3 #: Number of ammo packs (and crumbs) on each tile
+CHANNEL_CPS_OWN     = 4 #: Controlpoints held by the observer's team
+CHANNEL_CPS_FOE     = 5 #: Controlpoints held by the other team
+CHANNEL_CPS_NEUTRAL = 6 #: Neutral controlpoints
+NUM_CHANNELS        = 7
+
+#: Names of the scalar features, in order.
+FEATURES = ('x', 'y', 'angle', 'ammo', 'respawn_in', 'score_own', 'score_foe', 'step')
+
+KIND_TANK, KIND_AMMO, KIND_CP = 0, 1, 2
+
+### CLASSES ###
+
+class TensorObserver(object):
+    """ Fills the array observations of all tanks.
+
+        For each team there is one ``uint8`` array of shape
+        ``(tanks, NUM_CHANNELS, size, size)`` with a patch of tiles
+        around each tank, and one ``float32`` array of shape
+        ``(tanks, len(FEATURES))``. The patch is the same one as in
+        ``Observation.walls``. The observation of each tank holds views
+        into the rows of its team's arrays, so the arrays are allocated
+        once, and refilled in place every step.
+    """
+
+    def __init__(self, game):
+        self.game = game
+        field = game.field
+        self.radius = r = (game.settings.max_see/2+1)//field.tilesize
+        self.size = s = 2 * r + 1
+        # Walls with a border of 'outside' as wide as the patch radius
+        self.walls = np.ones((field.height + 2 * r, field.width + 2 * r), np.uint8)
+        self.walls[r:r + field.height, r:r + field.width] = np.array(field.wallgrid, np.uint8)
+        self.offsets = np.arange(s)
+        #: The spatial arrays, indexed by team
+        self.spatial = [None, None]
+        #: The feature arrays, indexed by team
+        self.features = [None, None]
+        self.tank_index = [None, None]
+        for team, tanks in ((TEAM_RED, game.tanks_red), (TEAM_BLUE, game.tanks_blue)):
+            self.spatial[team] = np.zeros((len(tanks), NUM_CHANNELS, s, s), np.uint8)
+            self.features[team] = np.zeros((len(tanks), len(FEATURES)), np.float32)
+            self.tank_index[team] = np.array([game.tanks.index(t) for t in tanks], int)
+            for k, tank in enumerate(tanks):
+                tank.observation.spatial = self.spatial[team][k]
+                tank.observation.features = self.features[team][k]
+        self.tank_team = np.array([t.team for t in game.tanks], int)
+        # Controlpoints don't move, so their tiles are computed once
+        self.cp_x = np.array([int(cp.cx // field.tilesize) for cp in game.controlpoints], int)
+        self.cp_y = np.array([int(cp.cy // field.tilesize) for cp in game.controlpoints], int)
+        # Entity buffers, grown when there are more entities
+        self._reserve(len(game.tanks) + len(game.controlpoints) + 16)
+
+    def _reserve(self, n):
+        self.ex    = np.zeros(n, int)
+        self.ey    = np.zeros(n, int)
+        self.eteam = np.zeros(n, int)
+        self.ekind = np.zeros(n, int)
+        nt, nc = len(self.game.tanks), len(self.game.controlpoints)
+        self.ekind[:nt] = KIND_TANK
+        self.ekind[nt:nt + nc] = KIND_CP
+        self.ekind[nt + nc:] = KIND_AMMO
+        self.eteam[:nt] = self.tank_team
+
+    def update(self):
+        """ Refills the arrays for the current step. The attributes of
+            the tanks and ammo are read into arrays with ``np.fromiter``,
+            so no lists or tuples are built.
+        """
+        game = self.game
+        ts = game.field.tilesize
+        r, s = self.radius, self.size
+        tanks = game.tanks
+        nt, nc = len(tanks), len(game.controlpoints)
+        # Tank centers, like Observation.loc
+        siz = tanks[0].width / 2.0 if nt else 0.0
+        px = (np.fromiter((t.x for t in tanks), float, nt) + siz).astype(int)
+        py = (np.fromiter((t.y for t in tanks), float, nt) + siz).astype(int)
+        ammo_x = np.fromiter((o.cx for o in game.broadphase_stat if isinstance(o, Ammo)), int)
+        ammo_y = np.fromiter((o.cy for o in game.broadphase_stat if isinstance(o, Ammo)), int)
+        # Gather the tiles of all entities: tanks, controlpoints, then ammo
+        n = nt + nc + len(ammo_x)
+        if n > len(self.ex):
+            self._reserve(2 * n)
+        self.ex[:nt] = px // ts
+        self.ey[:nt] = py // ts
+        self.ex[nt:nt + nc] = self.cp_x
+        self.ey[nt:nt + nc] = self.cp_y
+        self.eteam[nt:nt + nc] = np.fromiter((cp.team for cp in game.controlpoints), int, nc)
+        self.ex[nt + nc:n] = ammo_x // ts
+        self.ey[nt + nc:n] = ammo_y // ts
+        ex, ey, eteam, ekind = self.ex[:n], self.ey[:n], self.eteam[:n], self.ekind[:n]
+        for team in (TEAM_RED, TEAM_BLUE):
+            spatial = self.spatial[team]
+            index = self.tank_index[team]
+            if not len(index):
+                continue
+            tx, ty = ex[index], ey[index]
+            # Walls
+            rows = ty[:, None] + self.offsets
+            cols = tx[:, None] + self.offsets
+            spatial[:, CHANNEL_WALLS] = self.walls[rows[:, :, None], cols[:, None, :]]
+            # Entities, relative to each tank
+            spatial[:, CHANNEL_FRIENDS:] = 0
+            channel = np.where(ekind == KIND_AMMO, CHANNEL_AMMO,
+                      np.where(ekind == KIND_TANK,
+                               np.where(eteam == team, CHANNEL_FRIENDS, CHANNEL_FOES),
+                      np.where(eteam == team, CHANNEL_CPS_OWN,
+                      np.where(eteam == TEAM_NEUTRAL, CHANNEL_CPS_NEUTRAL, CHANNEL_CPS_FOE))))
+            rx = ex - tx[:, None] + r
+            ry = ey - ty[:, None] + r
+            inside = (rx >= 0) & (rx < s) & (ry >= 0) & (ry < s)
+            inside[np.arange(len(index)), index] = False
+            k, e = np.nonzero(inside)
+            np.add.at(spatial, (k, channel[e], ry[k, e], rx[k, e]), 1)
+        # Scalar features
+        angle = np.fromiter((t.angle for t in tanks), float, nt)
+        ammo = np.fromiter((t.ammo for t in tanks), float, nt)
+        respawn_in = np.fromiter((t.respawn_in for t in tanks), float, nt)
+        for team in (TEAM_RED, TEAM_BLUE):
+            features = self.features[team]
+            index = self.tank_index[team]
+            if team == TEAM_RED:
+                own, foe = game.score_red, game.score_blue
+            else:
+                own, foe = game.score_blue, game.score_red
+            features[:, 0] = px[index]
+            features[:, 1] = py[index]
+            features[:, 2] = angle[index]
+            features[:, 3] = ammo[index]
+            features[:, 4] = respawn_in[index]
+            features[:, 5] = own
+            features[:, 6] = foe
+            features[:, 7] = game.step
@@ -9,14 +9,20 @@ working properly. This includes saving fields and replays.
 
 # Python Imports
 import os
+import math
+import random
 import unittest
 import shutil
 import tempfile
+import zipfile
+import copy
 import cPickle as pickle
+from cStringIO import StringIO
 
 # Local Imports
 import core
 import tournament
+import scheduler
 from utilities import *
 
 ### CONSTANTS
@@ -41,6 +47,73 @@ class Agent(object):
         pass
 """
 
+TEAM_AGENT = """
+class Agent(object):
+    NAME = "teamagent"
+    
+    def __init__(self, id, team, *args, **kwargs):
+        self.id = id
+        self.team_obs = None
+        self.last = None
+    
+    def observe_team(self, team_obs):
+        self.team_obs = team_obs
+    
+    def observe(self, obs):
+        seen = set(foe for o in self.team_obs.observations for foe in o.foes)
+        if (obs.step != self.team_obs.step or obs.cps is not self.team_obs.cps or 
+            len(seen) != len(self.team_obs.foes) or seen != set(self.team_obs.foes)):
+            raise Exception("Team observation does not match agent observations.")
+        last = self.last or (obs.loc[0], obs.loc[1], obs.ammo)
+        if self.team_obs.deltas[self.id] != (obs.loc[0] - last[0], obs.loc[1] - last[1], obs.ammo - last[2]):
+            raise Exception("Team observation deltas do not match agent observations.")
+        self.last = (obs.loc[0], obs.loc[1], obs.ammo)
+        # Agents can't change what the other agents see
+        if not isinstance(obs.cps, tuple):
+            raise Exception("Controlpoints should be a tuple.")
+    
+    def action(self):
+        return (-pi + rand()*2*pi, 100, True)
+    
+    def debug(self, surface):
+        pass
+    
+    def finalize(self, interrupted=False):
+        pass
+"""
+
+ASYNC_AGENT = """
+class Pending(object):
+    def __init__(self, action):
+        self.action = action
+        self.checks = 0
+    
+    def done(self):
+        self.checks += 1
+        return self.checks > 2
+    
+    def result(self):
+        return self.action
+
+class Agent(object):
+    NAME = "asyncagent"
+    
+    def __init__(self, *args, **kwargs):
+        pass
+    
+    def observe(self, *args):
+        print 'async'
+    
+    def action_async(self):
+        return Pending((-pi + rand()*2*pi, 100, True))
+    
+    def debug(self, surface):
+        pass
+    
+    def finalize(self, interrupted=False):
+        pass
+"""
+
 SMALL_FIELD = """
 w w w w w w w w w w w w w w w w w w w
 w _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ w
@@ -104,12 +177,95 @@ class TestDominationGame(unittest.TestCase):
             self.assertEqual(len(f.find(core.Field.AMMO)), 6)
         f3 = core.Field.from_string(SMALL_FIELD)
                 
+    def test_nav_mesh(self):
+        f = core.FieldGenerator().generate()
+        mesh = make_nav_mesh(f.wallrects, simplify=0.3)
+        navmesh = NavMesh(mesh)
+        self.assertEqual(navmesh, mesh)
+        node = iter(navmesh).next()
+        navmesh[node].clear()
+        self.assertEqual(navmesh[node], mesh[node])
+        def mutate():
+            navmesh[node] = {}
+        self.assertRaises(TypeError, mutate)
+        def replace():
+            navmesh.nodes = ()
+        self.assertRaises(AttributeError, replace)
+        self.assertEqual(type(copy.deepcopy(navmesh)), dict)
+        i = navmesh.node_id(node)
+        self.assertEqual(dict((navmesh.nodes[j], length) for (k, j, length) in navmesh.edges(i)), mesh[node])
+        # Paths on the arrays should be as short as on the dicts
+        clear = [(j * f.tilesize + 8, i * f.tilesize + 8) for i in xrange(f.height) 
+                 for j in xrange(f.width) if not f.wallgrid[i][j]]
+        for i in xrange(100):
+            start, end = random.choice(clear), random.choice(clear)
+            lengths = []
+            for m in (mesh, navmesh):
+                path = [start] + find_path(start, end, m, f.wallgrid, f.tilesize)
+                lengths.append(sum(point_dist(a, b) for (a, b) in zip(path[:-1], path[1:])))
+            self.assertAlmostEqual(*lengths)
+        
+    def test_flow_fields(self):
+        f = core.FieldGenerator().generate()
+        flow = f.flow_fields
+        clear = [(j * f.tilesize + 8, i * f.tilesize + 8) for i in xrange(f.height) 
+                 for j in xrange(f.width) if not f.wallgrid[i][j]]
+        for (x, y) in f.find(core.Field.CONTROL):
+            target = (x * f.tilesize + 8, y * f.tilesize + 8)
+            for loc in random.sample(clear, 20):
+                if flow.distance(target, loc) == inf:
+                    continue
+                # Following the waypoints should get closer with every step
+                for _ in xrange(f.width * f.height):
+                    if loc == target:
+                        break
+                    waypoint = flow.next_waypoint(target, loc)
+                    self.assertTrue(flow.distance(target, waypoint) < flow.distance(target, loc))
+                    self.assertFalse(line_intersects_grid(loc, waypoint, f.wallgrid, f.tilesize))
+                    loc = waypoint
+                self.assertEqual(loc, target)
+            # The cached fields are shared, so agents can't change them
+            dist, next_tiles = flow.field(target)
+            self.assertEqual((type(dist), type(next_tiles)), (tuple, tuple))
+        for name in ('grid', 'tilesize', 'width', 'height', '_fields'):
+            self.assertRaises(AttributeError, setattr, flow, name, 1)
+        self.assertEqual(type(flow.grid[0]), tuple)
+        self.assertTrue(core._accepts_argument(core.AgentStub, 'flow_fields'))
+
+    def test_grid_distances(self):
+        f = core.FieldGenerator().generate()
+        clear = [(x, y) for y in xrange(f.height) for x in xrange(f.width) if not f.wallgrid[y][x]]
+        for i in xrange(20):
+            source = random.choice(clear)
+            distances = grid_distances(f.wallgrid, source)
+            for (x, y) in random.sample(clear, 20):
+                length = grid_path_length(source, (x, y), f.wallgrid)
+                self.assertEqual(distances[y][x], -1 if length is None else length)
+
+    def test_assignment(self):
+        from libs import munkres, assignment
+        matrices = [[[random.randint(0, 20) for j in xrange(6)] for i in xrange(random.randint(1, 8))]
+                    for k in xrange(200)]
+        cost = lambda matrix, indexes: sum(matrix[i][j] for (i, j) in indexes)
+        for matrix, batched in zip(matrices, assignment.compute_many(matrices)):
+            indexes = assignment.Munkres().compute(matrix)
+            self.assertEqual(cost(matrix, indexes), cost(matrix, munkres.Munkres().compute(matrix)))
+            self.assertEqual(cost(matrix, batched), cost(matrix, indexes))
+            self.assertEqual(len(set(j for (i, j) in indexes)), min(len(matrix), 6))
+
     def test_string_agent(self):
         game = core.Game(red=RANDOM_AGENT, 
                          blue=RANDOM_AGENT, 
                          rendered=False)
         game.run()
     
+    def test_team_observation(self):
+        game = core.Game(red=TEAM_AGENT, 
+                         blue=TEAM_AGENT,
+                         settings=core.Settings(max_steps=100),
+                         rendered=False, verbose=False, hard_errors=True)
+        game.run()
+    
     def test_replay(self):
         settings = core.Settings(max_steps=200)
         for i in range(40):
@@ -118,7 +274,277 @@ class TestDominationGame(unittest.TestCase):
             replaygame = core.Game(replay=game.replay, rendered=False, verbose=False)
             replaygame.run()
             self.assertEqual(replaygame.score_red, game.score_red)
+
+    def test_verify_replays(self):
+        import scenarios
+        tmpdir = tempfile.mkdtemp()
+        settings = core.Settings(max_steps=50)
+        for i in range(2):
+            game = core.Game(settings=settings, record=True, rendered=False, verbose=False).run()
+            if i == 1:
+                game.replay.stats.score_red += 1
+            pickle.dump(game.replay, open(os.path.join(tmpdir, 'replay_%d.pickle' % i), 'wb'))
+        rows = scenarios.verify_replays([tmpdir], output=os.path.join(tmpdir, 'games.csv'), processes=2)
+        self.assertEqual([row['mismatch'] for row in rows], [False, True])
+        shutil.rmtree(tmpdir)
+
+    def test_replay_archive(self):
+        import scenarios
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'replays.zip')
+        zipf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        scores = {}
+        for i in range(3):
+            game = core.Game(settings=core.Settings(max_steps=20), record=True, rendered=False, verbose=False).run()
+            name = 'replay_%04d_red%d_vs_blue.pickle' % (i, i)
+            zipf.writestr(name, pickle.dumps(game.replay, pickle.HIGHEST_PROTOCOL))
+            scores[name] = {'score_red': game.score_red, 'red_file': 'agents/red%d.py' % i}
+        zipf.close()
+        # Without an index, the agents are found from the names
+        with scenarios.ReplayArchive(path) as archive:
+            unindexed = [g['replay'] for g in archive.find(red='red1')]
+        scenarios.write_replay_index(path, scores)
+        with scenarios.ReplayArchive(path) as archive:
+            self.assertEqual(len(archive), 3)
+            self.assertEqual([g['replay'] for g in archive.find(red='red1')], unindexed)
+            self.assertEqual(archive.find(red='agents/red1.py'), archive.find(red='red1'))
+            game = archive.find(red='red1')[0]
+            self.assertEqual(archive.load(game).stats.score_red, game['score_red'])
+            with zipfile.ZipFile(path) as zipf:
+                self.assertEqual(archive.read(2), zipf.read(archive.games[2]['replay']))
+        shutil.rmtree(tmpdir)
+
+    def test_physics_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            print("It looks like you don't have numpy installed, skipping the array physics test.")
+            return
+        # Actions recorded with one physics give the same game with the other
+        for recorded, replayed in ((core.PHYSICS_PYTHON, core.PHYSICS_NUMPY),
+                                   (core.PHYSICS_NUMPY, core.PHYSICS_PYTHON)):
+            settings = core.Settings(max_steps=100, physics=recorded)
+            game = core.Game(settings=settings, record=True, rendered=False, verbose=False)
+            game.run()
+            game.replay.settings.physics = replayed
+            replaygame = core.Game(replay=game.replay, rendered=False, verbose=False)
+            replaygame.run()
+            self.assertEqual(replaygame.settings.physics, replayed)
+            self.assertEqual((replaygame.score_red, replaygame.score_blue), (game.score_red, game.score_blue))
+            self.assertEqual((replaygame.stats.deaths_red, replaygame.stats.deaths_blue), 
+                             (game.stats.deaths_red, game.stats.deaths_blue))
+            for tank, replayed_tank in zip(game.tanks, replaygame.tanks):
+                self.assertAlmostEqual(replayed_tank.x, tank.x, places=3)
+                self.assertAlmostEqual(replayed_tank.y, tank.y, places=3)
             
+    def test_raycast_many(self):
+        try:
+            import numpy
+        except ImportError:
+            print("It looks like you don't have numpy installed, skipping the raycast test.")
+            return
+        game = core.Game(settings=core.Settings(max_steps=1), rendered=False, verbose=False).run()
+        rng = random.Random(1)
+        origins, targets, exclude = [], [], []
+        for tank in game.tanks:
+            for i in xrange(50):
+                angle, dist = rng.random() * 2 * pi, rng.random() * 400
+                p0 = (tank._x + tank.width/2, tank._y + tank.height/2)
+                origins.append(p0)
+                targets.append((p0[0] + math.cos(angle) * dist, p0[1] + math.sin(angle) * dist))
+                exclude.append(tank)
+        hits = game.raycast_many(origins, targets, exclude)
+        for (p0, p1, tank, hit) in zip(origins, targets, exclude, hits):
+            single = game._raycast(p0, p1, exclude=tank)
+            self.assertEqual(hit, single[0] if single else None)
+
+    def test_observation_arrays(self):
+        try:
+            import numpy
+        except ImportError:
+            print("It looks like you don't have numpy installed, skipping the array observation test.")
+            return
+        import tensors
+        def check(game):
+            ts = game.field.tilesize
+            r = game.tensors.radius
+            for tank in game.tanks:
+                obs = tank.observation
+                self.assertEqual(obs.spatial[tensors.CHANNEL_WALLS].tolist(), obs.walls)
+                self.assertEqual(obs.features[tensors.FEATURES.index('ammo')], obs.ammo)
+                self.assertLessEqual(obs.spatial[tensors.CHANNEL_CPS_OWN:].sum(), len(obs.cps))
+                if obs.step == 0:
+                    continue
+                # Place everything that the tank observes on its own grid
+                expected = numpy.zeros(obs.spatial.shape, int)
+                expected[tensors.CHANNEL_WALLS] = obs.walls
+                tx, ty = obs.loc[0] // ts, obs.loc[1] // ts
+                entities = ([(x, y, tensors.CHANNEL_FRIENDS) for (x, y) in obs.friends] +
+                            [(x, y, tensors.CHANNEL_FOES) for (x, y, a) in obs.foes] +
+                            [(x, y, tensors.CHANNEL_AMMO) for (x, y, kind) in obs.objects])
+                for (x, y, team) in obs.cps:
+                    if team == tank.team:
+                        entities.append((x, y, tensors.CHANNEL_CPS_OWN))
+                    elif team == core.TEAM_NEUTRAL:
+                        entities.append((x, y, tensors.CHANNEL_CPS_NEUTRAL))
+                    else:
+                        entities.append((x, y, tensors.CHANNEL_CPS_FOE))
+                for (x, y, channel) in entities:
+                    i, j = y // ts - ty + r, x // ts - tx + r
+                    if 0 <= i < expected.shape[1] and 0 <= j < expected.shape[2]:
+                        expected[channel, i, j] += 1
+                self.assertEqual(obs.spatial.tolist(), expected.tolist())
+                features = [obs.loc[0], obs.loc[1], obs.angle, obs.ammo, obs.respawn_in, 
+                            obs.score[tank.team], obs.score[1 - tank.team], obs.step]
+                self.assertEqual(obs.features.tolist(), numpy.array(features, numpy.float32).tolist())
+        settings = core.Settings(max_steps=50, observation=core.OBSERVATION_ARRAYS)
+        core.Game(settings=settings, step_callback=check, rendered=False, verbose=False).run()
+
+    def test_telemetry(self):
+        try:
+            import numpy
+        except ImportError:
+            print("It looks like you don't have numpy installed, skipping the telemetry test.")
+            return
+        import telemetry
+        settings = core.Settings(max_steps=80, end_condition=core.ENDGAME_NONE)
+        self.assertEqual(core.Game(settings=settings, rendered=False, verbose=False).run().telemetry, None)
+        game = core.Game(settings=settings, telemetry=True, rendered=False, verbose=False).run()
+        data = game.telemetry.arrays()
+        self.assertEqual(data['x'].shape, (80, len(game.tanks)))
+        self.assertEqual(data['cps'].shape, (80, len(game.controlpoints)))
+        self.assertEqual(data['step'].tolist(), range(1, 81))
+        self.assertEqual(data['score_red'][-1], game.stats.score_red)
+        self.assertEqual(data['ammo_red'].sum(), game.stats.ammo_red)
+        self.assertEqual(data['ammo_blue'].sum(), game.stats.ammo_blue)
+        self.assertEqual(data['x'][-1].tolist(), [numpy.float32(t.x) for t in game.tanks])
+        self.assertEqual(data['killed'][:, data['team'] == core.TEAM_RED].sum(), game.stats.deaths_red)
+        self.assertTrue(data['killed'].sum() <= (data['hit'] >= 0).sum())
+        f = StringIO()
+        game.telemetry.save(f)
+        f.seek(0)
+        loaded = telemetry.load(f)
+        self.assertEqual(sorted(loaded), sorted(data))
+        self.assertEqual(loaded['y'].tolist(), data['y'].tolist())
+
+    def test_log(self):
+        agent = RANDOM_AGENT.replace("def observe(self, *args):\n        pass",
+                                     "def observe(self, *args):\n        print 'x' * 100")
+        spill = StringIO()
+        log = core.GameLog(max_kbs=4, rate_kbs=0.25, spill=spill)
+        settings = core.Settings(max_steps=50)
+        game = core.Game(agent, agent, settings=settings, rendered=False, log=log).run()
+        self.assertTrue(log.size <= 4 * 1024)
+        self.assertEqual(log.dropped, len(spill.getvalue()))
+        self.assertTrue('GAME STATS' in log.text('engine'))
+        self.assertTrue('LIMITED' in log.text('engine'))
+        self.assertTrue(log.text('red'))
+        self.assertEqual(log.text('red').strip('x\n'), '')
+        # Both teams get to print 256 bytes per step
+        self.assertTrue(log.dropped + log.size < 50 * 2 * 300 + 4 * 1024)
+        # Truncating keeps the end, with the game stats
+        truncated = log.truncated(kbs=2)
+        self.assertTrue(len(truncated) <= 2 * 1024)
+        self.assertTrue(truncated.startswith('== LOG TRUNCATED'))
+        self.assertTrue(truncated.endswith(log.text()[-1024:]))
+        self.assertTrue('GAME STATS' in log.truncated(kbs=4))
+        # Nothing is spilled after the log is closed
+        dropped, spilled = log.dropped, spill.getvalue()
+        log.write('y' * 8 * 1024)
+        self.assertTrue(log.dropped > dropped)
+        self.assertEqual(spill.getvalue(), spilled)
+        # Agents can't tag their output as someone else's
+        self.assertRaises(AttributeError, setattr, log, 'source', 'engine')
+        agent = RANDOM_AGENT.replace("def observe(self, *args):\n        pass",
+                                     "def observe(self, *args):\n        import sys\n"
+                                     "        print hasattr(sys.stdout, 'entries'), hasattr(sys.stdout, 'local'),\n"
+                                     "        print [n for n in dir(sys.stdout) if 'log' in n or 'target' in n]")
+        game = core.Game(agent, agent, settings=settings, rendered=False, verbose=False).run()
+        self.assertEqual(set(game.log.text('red').split()), set(['False', '[]']))
+
+    def test_threads(self):
+        import threading
+        import sys
+        stdout = sys.stdout
+        settings = core.Settings(max_steps=30)
+        agents = [RANDOM_AGENT.replace('NAME = "randomagent"', 'NAME = "agent%d"'%i).replace(
+                  "def observe(self, *args):\n        pass", 
+                  "def observe(self, *args):\n        print 'agent%d'"%i) for i in range(4)]
+        field = core.FieldGenerator().generate()
+        games = [core.Game(agent, agent, settings=settings, field=field, rendered=False, verbose=False) 
+                 for agent in agents]
+        threads = [threading.Thread(target=game.run) for game in games]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(sys.stdout is stdout)
+        # Games on the same field have their own walls
+        for game in games:
+            self.assertTrue(all(wall.game is game for wall in game.walls))
+        for i, game in enumerate(games):
+            printed = set(game.log.text('red').split())
+            self.assertEqual(printed, set(['agent%d'%i]))
+        # Agents that use the print function write to the log directly
+        agent = "from __future__ import print_function\n" + agents[0].replace("print 'agent0'", "print('agent', 0, sep='')")
+        game = core.Game(agent, agent, settings=settings, rendered=False, verbose=False).run()
+        self.assertEqual(set(game.log.text('blue').split()), set(['agent0']))
+        # Games that fail don't keep the output of the thread
+        game = core.Game(settings=settings, rendered=False, verbose=False)
+        game.field = None
+        self.assertRaises(AttributeError, game.run)
+        self.assertTrue(sys.stdout is stdout)
+        def fail(game):
+            raise ValueError()
+        game = core.Game(settings=settings, step_callback=fail, rendered=False, verbose=False)
+        self.assertRaises(ValueError, game.run)
+        self.assertTrue(sys.stdout is stdout)
+
+    def test_scheduler(self):
+        import sys
+        stdout = sys.stdout
+        order = []
+        settings = core.Settings(max_steps=20)
+        games = [core.Game(ASYNC_AGENT, RANDOM_AGENT, settings=settings, rendered=False, verbose=False,
+                           step_callback=lambda game, i=i: order.append(i)) for i in range(3)]
+        finished = scheduler.GameScheduler(games).run()
+        self.assertEqual(sorted(finished), sorted(games))
+        self.assertTrue(sys.stdout is stdout)
+        # The games took turns
+        self.assertEqual(order[:6], [0, 1, 2, 0, 1, 2])
+        for game in games:
+            self.assertEqual(game.stats.steps, 20)
+            self.assertEqual(set(game.log.text('red').split()), set(['async']))
+            self.assertFalse(game.red.raised_exception)
+        # Run on its own, the game waits for the actions
+        game = core.Game(ASYNC_AGENT, ASYNC_AGENT, settings=settings, rendered=False, verbose=False).run()
+        self.assertEqual(game.stats.steps, 20)
+        self.assertFalse(game.blue.raised_exception)
+        # Actions that raise or never finish don't hold up the other games
+        failing = ASYNC_AGENT.replace("self.checks += 1", "raise ValueError()")
+        stalled = ASYNC_AGENT.replace("return self.checks > 2", "return False")
+        settings = core.Settings(max_steps=20, async_timeout=0.01)
+        games = [core.Game(failing, RANDOM_AGENT, settings=settings, rendered=False, verbose=False),
+                 core.Game(RANDOM_AGENT, stalled, settings=settings, rendered=False, verbose=False),
+                 core.Game(ASYNC_AGENT, ASYNC_AGENT, settings=settings, rendered=False, verbose=False)]
+        scheduler.GameScheduler(games).run()
+        self.assertTrue(all(game.stats.steps == 20 for game in games))
+        self.assertTrue(games[0].red.raised_exception)
+        self.assertFalse(games[1].blue.raised_exception)
+        self.assertTrue('BLU-0 timed out' in games[1].log.text('engine'))
+        self.assertFalse(games[2].red.raised_exception or games[2].blue.raised_exception)
+        game = core.Game(RANDOM_AGENT, stalled, settings=settings, rendered=False, verbose=False).run()
+        self.assertEqual(game.stats.steps, 20)
+        self.assertTrue('timed out' in game.log.text('engine'))
+        # Waiting for the other games doesn't count as think time
+        ready = ASYNC_AGENT.replace("return self.checks > 2", "return True")
+        settings = core.Settings(max_steps=10)
+        games = [core.Game(ready, ready, settings=settings, rendered=False, verbose=False) for _ in range(25)]
+        scheduler.GameScheduler(games).run()
+        for game in games:
+            self.assertEqual(game.stats.steps, 10)
+            self.assertFalse('timed out' in game.log.text('engine'))
+
     def test_tournament(self):
         tmpdir = '_tmp'
         if not os.path.exists(tmpdir):
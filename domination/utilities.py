@@ -9,6 +9,8 @@
 import math
 import time
 import copy
+import collections
+from array import array
 from pprint import pprint
 from heapq import heappush, heappop
 from sys import maxint
@@ -255,6 +257,65 @@ def line_intersects_grid((x0,y0), (x1,y1), grid, grid_cell_size=1):
         n -= 1
     return False
     
+def line_grid_hits((x0,y0), (x1,y1), grid, grid_cell_size=1):
+    """ Walks the "super cover" of a line like :func:`line_intersects_grid`,
+        and yields the (x, y) indices of the occupied grid cells that it
+        passes through, in the order that the line reaches them. The walk
+        stops at the edge of the grid, so the line can leave the grid.
+        
+        >>> list(line_grid_hits((0,0),(3,3),[[0,0,0],[0,1,0],[0,0,2]]))
+        [(1, 1), (2, 2)]
+    """
+    h, w = len(grid), len(grid[0])
+    grid_cell_size = float(grid_cell_size)
+    x0 = x0 / grid_cell_size
+    x1 = x1 / grid_cell_size
+    y0 = y0 / grid_cell_size
+    y1 = y1 / grid_cell_size
+    dx = abs(x1 - x0)
+    dy = abs(y1 - y0)
+    x = int(math.floor(x0))
+    y = int(math.floor(y0))
+    dt_dx = 1.0 / dx if dx != 0 else inf
+    dt_dy = 1.0 / dy if dy != 0 else inf
+    n = 1
+    if (dx == 0):
+        x_inc = 0
+        t_next_horizontal = dt_dx
+    elif (x1 > x0):
+        x_inc = 1
+        n += int(math.floor(x1)) - x
+        t_next_horizontal = (math.floor(x0) + 1 - x0) * dt_dx
+    else:
+        x_inc = -1
+        n += x - int(math.floor(x1))
+        t_next_horizontal = (x0 - math.floor(x0)) * dt_dx
+    if (dy == 0):
+        y_inc = 0
+        t_next_vertical = dt_dy
+    elif (y1 > y0):
+        y_inc = 1
+        n += int(math.floor(y1)) - y
+        t_next_vertical = (math.floor(y0) + 1 - y0) * dt_dy
+    else:
+        y_inc = -1
+        n += y - int(math.floor(y1))
+        t_next_vertical = (y0 - math.floor(y0)) * dt_dy
+    while n > 0 and 0 <= x < w and 0 <= y < h:
+        if grid[y][x]:
+            yield (x, y)
+        if (t_next_vertical == t_next_horizontal and y_inc and 
+            0 <= y + y_inc < h and grid[y + y_inc][x]):
+            # Line passes exactly through a corner, it touches both neighbours
+            yield (x, y + y_inc)
+        if (t_next_vertical < t_next_horizontal):
+            y += y_inc
+            t_next_vertical += dt_dy
+        else:
+            x += x_inc
+            t_next_horizontal += dt_dx
+        n -= 1
+    
 def rect_contains_point(rect, point):
     """ Check if rectangle contains a point. """
     if (rect[0] <= point[0] and
@@ -370,44 +431,157 @@ def reachable(grid, (x, y), border=1):
     return reachability
     
 def grid_path_length((x,y),(gx,gy),g):
-    #Path list (current coords, cost, expected cost)
-    p = [((x,y),0,abs(gx-x)+abs(gy-y))]
-    #Nodes visited
-    h = []
-    #Max values of coords
-    m = (len(g[0]),len(g))
-    while (len(p) > 0):
-        #Sort based on best estimate of distance, with slight advantage 
-        #to paths already explored
-        p.sort(key=lambda o:0.99999*o[1]+o[2])
-        #Best current loc
-        (x,y) = p[0][0]
-        l = []
-        #Expand in all 4 directions, add if:
-        #   1. Not of of bounds 2. No wall present 3. Not yet visited
-        n = x-1
-        if n >= 0 and g[y][n] == 0 and (n,y) not in h:
-            l.append(((n,y),abs(gx-n)+abs(gy-y)))
-        n = x+1
-        if n < m[0] and g[y][n] == 0 and (n,y) not in h:
-            l.append(((n,y),abs(gx-n)+abs(gy-y)))
-        n = y-1
-        if n >= 0 and g[n][x] == 0 and (x,n) not in h:
-            l.append(((x,n),abs(gx-x)+abs(gy-n)))
-        n = y+1
-        if n < m[1] and g[n][x] == 0 and (x,n) not in h:
-            l.append(((x,n),abs(gx-x)+abs(gy-n)))
+    """ Number of steps on the shortest path between two tiles, moving
+        horizontally and vertically over clear tiles, found with an A*
+        search. Returns None if there is no path.
         
-        #Add all new valid paths to path list and history
-        for i in l:
-            if i[1] == 0:
-                #Goal reached
-                return p[0][1]+1
-            h.append(i[0])
-            p.append((i[0],p[0][1]+1,i[1]))
-        #Remove old path
-        del p[0]
+        >>> grid_path_length((0,0), (2,0), [[0,1,0],[0,0,0]])
+        4
+    """
+    if (x, y) == (gx, gy):
+        return 0
+    w, h = len(g[0]), len(g)
+    visited = bytearray(w * h)
+    # Heap of (estimated length, -steps, x, y), prefers longer paths on ties
+    heap = [(abs(gx-x) + abs(gy-y), 0, x, y)]
+    while heap:
+        _, steps, x, y = heappop(heap)
+        if visited[y * w + x]:
+            continue
+        visited[y * w + x] = 1
+        steps = 1 - steps
+        for (nx, ny) in ((x-1, y), (x+1, y), (x, y-1), (x, y+1)):
+            if 0 <= nx < w and 0 <= ny < h and g[ny][nx] == 0 and not visited[ny * w + nx]:
+                if nx == gx and ny == gy:
+                    return steps
+                heappush(heap, (steps + abs(gx-nx) + abs(gy-ny), -steps, nx, ny))
     return None
+    
+def grid_distances(g, (x,y)):
+    """ Number of steps on the shortest paths from tile (x, y) to all 
+        tiles, moving horizontally and vertically over clear tiles. 
+        Returns a list of rows (arrays) so that the distance to a tile is 
+        ``distances[y][x]``, with -1 for tiles that can't be reached.
+        Use this instead of :func:`grid_path_length` for many paths 
+        from the same tile.
+        
+        >>> [list(row) for row in grid_distances([[0,1,0],[0,0,0]], (0,0))]
+        [[0, -1, 4], [1, 2, 3]]
+    """
+    w, h = len(g[0]), len(g)
+    dist = array('i', [-1]) * (w * h)
+    dist[y * w + x] = 0
+    edge = collections.deque([(x, y)])
+    while edge:
+        x, y = edge.popleft()
+        d = dist[y * w + x] + 1
+        for (nx, ny) in ((x-1, y), (x+1, y), (x, y-1), (x, y+1)):
+            if 0 <= nx < w and 0 <= ny < h and g[ny][nx] == 0 and dist[ny * w + nx] == -1:
+                dist[ny * w + nx] = d
+                edge.append((nx, ny))
+    return [dist[i * w:(i + 1) * w] for i in xrange(h)]
+
+
+class FlowFields(object):
+    """ Shortest paths over the clear tiles of a grid, towards any 
+        target. For each target the distance from every tile, and the
+        next tile to go to, are computed once with Dijkstra's algorithm
+        (moving straight or diagonally, without cutting corners), and 
+        then cached. After that, each query is a lookup. It is shared
+        by all agents and games on a field, so the grid and the cached
+        fields are tuples, and the attributes are read-only.
+        
+        >>> flow = FlowFields([[0,0,0],[1,1,0],[0,0,0]], 1)
+        >>> flow.distance((0.5, 0.5), (0.5, 2.5))
+        6.0
+        >>> flow.next_waypoint((0.5, 0.5), (0.5, 2.5))
+        (1.5, 2.5)
+    """
+    def __init__(self, grid, tilesize=16):
+        set_attr = super(FlowFields, self).__setattr__
+        set_attr('_grid', tuple(tuple(row) for row in grid))
+        set_attr('_tilesize', tilesize)
+        set_attr('_width', len(grid[0]))
+        set_attr('_height', len(grid))
+        set_attr('_fields', {})
+        
+    def __setattr__(self, name, value):
+        raise AttributeError("FlowFields is read-only")
+        
+    @property
+    def grid(self):
+        """ The grid, a tuple of rows, where truthy tiles are walls. """
+        return self._grid
+        
+    @property
+    def tilesize(self):
+        """ The size of a tile, in game units. """
+        return self._tilesize
+        
+    @property
+    def width(self):
+        """ The width of the grid, in tiles. """
+        return self._width
+        
+    @property
+    def height(self):
+        """ The height of the grid, in tiles. """
+        return self._height
+        
+    def _tile(self, (x, y)):
+        return int(y // self._tilesize) * self._width + int(x // self._tilesize)
+    
+    def field(self, target):
+        """ Returns the (distances, next_tiles) tuples for the given 
+            target location, indexed by ``y * width + x`` tile index.
+        """
+        start = self._tile(target)
+        if start not in self._fields:
+            grid, w, h = self._grid, self._width, self._height
+            straight, diagonal = float(self._tilesize), self._tilesize * sqrt(2)
+            steps = ((0, 1, straight), (1, 0, straight), (0, -1, straight), (-1, 0, straight),
+                     (1, 1, diagonal), (1, -1, diagonal), (-1, 1, diagonal), (-1, -1, diagonal))
+            dist = [inf] * (w * h)
+            next_tiles = [-1] * (w * h)
+            dist[start] = 0.0
+            heap = [(0.0, start)]
+            while heap:
+                d, current = heappop(heap)
+                if d > dist[current]:
+                    continue
+                ci, cj = divmod(current, w)
+                for (di, dj, cost) in steps:
+                    i, j = ci + di, cj + dj
+                    if (0 <= i < h and 0 <= j < w and not grid[i][j] and 
+                        (di == 0 or dj == 0 or not (grid[ci][j] or grid[i][cj]))):
+                        k = i * w + j
+                        if d + cost < dist[k]:
+                            dist[k] = d + cost
+                            next_tiles[k] = current
+                            heappush(heap, (d + cost, k))
+            self._fields[start] = (tuple(dist), tuple(next_tiles))
+        return self._fields[start]
+    
+    def distance(self, target, location):
+        """ Length of the shortest path over the tiles from location to
+            target, or inf if there is none.
+        """
+        return self.field(target)[0][self._tile(location)]
+    
+    def next_waypoint(self, target, location):
+        """ The center of the next tile on the shortest path from location
+            to target, or the target itself when it's on the next tile.
+            Returns None if the target can't be reached.
+        """
+        dist, next_tiles = self.field(target)
+        tile = self._tile(location)
+        k = next_tiles[tile]
+        if k == -1:
+            return target if dist[tile] == 0 else None
+        if k == self._tile(target):
+            return target
+        ts, w = self._tilesize, self._width
+        return ((k % w) * ts + ts / 2.0, (k // w) * ts + ts / 2.0)
 
 
 def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
@@ -439,29 +613,202 @@ def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
                 if not any(line_intersects_rect(n1,n2,w) for w in walls):
                     mesh[n1][n2] = point_dist(n1,n2)
     # 4) Remove direct connections that are not much shorter than indirect ones
-    def astar_path_length(m, start, end):
-        """ Length of a path from start to end """
-        neighbours = lambda n: m[n].keys()
-        cost       = lambda n1, n2: m[n1][n2]
-        goal       = lambda n: n == end
-        heuristic  = lambda n: point_dist(end, n)
-        nodes, length = astar(start, neighbours, goal, 0, cost, heuristic)
-        return length
+    csr = NavMesh(mesh)
+    nodes = csr.nodes
+    removed = bytearray(csr.num_edges)
     connections = []
-    for n1 in mesh:
-        for n2 in mesh[n1]:
-            connections.append((mesh[n1][n2],(n1,n2)))
+    for i in xrange(len(nodes)):
+        for (k, j, length) in csr.edges(i):
+            connections.append((length, (nodes[i], nodes[j]), i, j, k))
     connections.sort(reverse=True) # Start with the longest connections
-    for length, (n1, n2) in connections:
-        mesh[n1].pop(n2) # Remove connection to see best path without it
-        alternative_dist = astar_path_length(mesh, n1,n2)
+    for length, (n1, n2), i, j, k in connections:
+        removed[k] = 1 # Remove connection to see best path without it
+        path, alternative_dist = csr.astar(i, j, removed=removed)
         # Put the connection back if the alternative is much worse
         if alternative_dist > (1+simplify) * length:
-            mesh[n1][n2] = length
-        
+            removed[k] = 0
+    for length, (n1, n2), i, j, k in connections:
+        if removed[k]:
+            mesh[n1].pop(n2)
     return mesh
 
 
+class NavMesh(collections.Mapping):
+    """ A frozen navigation mesh, that can be shared by all agents
+        and games on a field. It behaves like the read-only dict of 
+        dicts that :func:`make_nav_mesh` returns, but the connections 
+        are stored in compressed sparse row (CSR) form, in tuples that 
+        are only exposed through :attr:`nodes`, :meth:`node_id` and 
+        :meth:`edges`, so agents can't change the shared mesh.
+        
+        Looking up a node builds a new dict with its connections, which
+        takes time proportional to the number of connections. Code that
+        looks up many nodes should use :meth:`edges` instead. A deepcopy 
+        returns a plain dict of dicts.
+        
+        >>> mesh = NavMesh({(0, 0): {(1, 0): 1.0}, (1, 0): {(0, 0): 1.0}})
+        >>> mesh[(0, 0)]
+        {(1, 0): 1.0}
+    """
+    def __init__(self, mesh):
+        nodes = tuple(mesh)
+        index = dict((n, i) for (i, n) in enumerate(nodes))
+        offsets, neighbours, weights = [0], [], []
+        for n in nodes:
+            for (m, length) in mesh[n].iteritems():
+                neighbours.append(index[m])
+                weights.append(length)
+            offsets.append(len(neighbours))
+        set_attr = super(NavMesh, self).__setattr__
+        set_attr('_nodes', nodes)
+        set_attr('_index', index)
+        set_attr('_offsets', tuple(offsets))
+        set_attr('_neighbours', tuple(neighbours))
+        set_attr('_weights', tuple(weights))
+        
+    def __setattr__(self, name, value):
+        raise AttributeError("NavMesh is read-only")
+        
+    @property
+    def nodes(self):
+        """ The nodes, a tuple of (x, y) points, in the order of their ids. """
+        return self._nodes
+        
+    @property
+    def num_edges(self):
+        """ The number of (directed) connections. """
+        return len(self._neighbours)
+        
+    def node_id(self, node):
+        """ Returns the id of the given (x, y) node, or None. """
+        return self._index.get(node)
+        
+    def edges(self, i):
+        """ Yields the connections of node id ``i`` as (edge id, node id, 
+            length) tuples. Edge ids can be used to remove connections in 
+            :meth:`astar`.
+        """
+        neighbours, weights = self._neighbours, self._weights
+        for k in xrange(self._offsets[i], self._offsets[i+1]):
+            yield (k, neighbours[k], weights[k])
+    
+    def __getitem__(self, node):
+        i = self._index[node]
+        nodes, neighbours, weights = self._nodes, self._neighbours, self._weights
+        return dict((nodes[neighbours[k]], weights[k]) 
+                    for k in xrange(self._offsets[i], self._offsets[i+1]))
+    
+    def __iter__(self):
+        return iter(self._nodes)
+    
+    def __len__(self):
+        return len(self._nodes)
+    
+    def __contains__(self, node):
+        return node in self._index
+    
+    def __deepcopy__(self, memo):
+        return dict((n, self[n]) for n in self._nodes)
+    
+    def astar(self, start, goal, start_edges=None, goal_edges=None, removed=None):
+        """ A* search from node id ``start`` to node id ``goal``, 
+            expanding nodes in the same order as :func:`libs.astar.astar`
+            with a straight line distance heuristic. 
+            
+            The ids ``len(nodes)`` and ``len(nodes) + 1`` can be used for
+            a temporary start and goal, connected by ``start_edges``, a list 
+            of (id, length) tuples, and ``goal_edges``, a dict of 
+            {id: length}. Their positions are taken from the given
+            ``start`` and ``goal`` when those are (x, y) tuples. Edges can 
+            be skipped by setting their index in the ``removed`` bytearray.
+            
+            Like :func:`libs.astar.astar`, returns the path of node ids
+            excluding the start, and its length. If the goal can't be 
+            reached, the path leads to the node closest to it.
+        """
+        nodes, offsets, neighbours, weights = self._nodes, self._offsets, self._neighbours, self._weights
+        n = len(nodes)
+        xs, ys = [p[0] for p in nodes], [p[1] for p in nodes]
+        if isinstance(start, tuple):
+            xs.append(start[0])
+            ys.append(start[1])
+            start = n
+        else:
+            xs.append(0)
+            ys.append(0)
+        if isinstance(goal, tuple):
+            xs.append(goal[0])
+            ys.append(goal[1])
+            goal = n + 1
+        tx, ty = xs[goal], ys[goal]
+        g = [inf] * (n + 2)
+        h = [None] * (n + 2)
+        parent = [-1] * (n + 2)
+        h[start] = ((xs[start] - tx) ** 2 + (ys[start] - ty) ** 2) ** 0.5
+        g[start] = 0
+        num = 0
+        heap = [(h[start], h[start], num, 0, start)]
+        best, best_f = start, h[start]
+        while heap:
+            f, _, _, cg, current = heappop(heap)
+            if cg > g[current]:
+                continue
+            if current == goal:
+                best, best_f = current, f
+                break
+            if current == n:
+                edges = list(start_edges)
+            else:
+                edges = [(neighbours[k], weights[k]) for k in xrange(offsets[current], offsets[current + 1])
+                         if removed is None or not removed[k]]
+            if goal_edges is not None and current in goal_edges:
+                edges.append((n + 1, goal_edges[current]))
+            for (m, length) in edges:
+                mg = cg + length
+                if h[m] is None:
+                    h[m] = mh = ((xs[m] - tx) ** 2 + (ys[m] - ty) ** 2) ** 0.5
+                    g[m] = mg
+                    parent[m] = current
+                    num += 1
+                    heappush(heap, (mg + mh, mh, num, mg, m))
+                    if mh < h[best]:
+                        best, best_f = m, mg + mh
+                elif mg < g[m]:
+                    g[m] = mg
+                    parent[m] = current
+                    num += 1
+                    heappush(heap, (mg + h[m], h[m], num, mg, m))
+        path = []
+        while parent[best] != -1:
+            path.append(best)
+            best = parent[best]
+        path.reverse()
+        return path, (best_f if path else inf)
+    
+    def distances(self, source):
+        """ Dijkstra's algorithm from node id ``source``, returns a 
+            list with the length of the shortest path to each node id.
+        """
+        offsets, neighbours, weights = self._offsets, self._neighbours, self._weights
+        dist = [inf] * len(self._nodes)
+        dist[source] = 0
+        heap = [(0, source)]
+        while heap:
+            d, current = heappop(heap)
+            if d > dist[current]:
+                continue
+            for k in xrange(offsets[current], offsets[current + 1]):
+                m = neighbours[k]
+                md = d + weights[k]
+                if md < dist[m]:
+                    dist[m] = md
+                    heappush(heap, (md, m))
+        return dist
+        
+    def __repr__(self):
+        return 'NavMesh(%r)' % (copy.deepcopy(self),)
+
+
 def find_path(start, end, mesh, grid, tilesize=16):
     """ Uses astar to find a path from start to end,
         using the given mesh and tile grid.
@@ -474,6 +821,20 @@ def find_path(start, end, mesh, grid, tilesize=16):
     # If there is a straight line, just return the end point
     if not line_intersects_grid(start, end, grid, tilesize):
         return [end]
+    if isinstance(mesh, NavMesh):
+        # Search the arrays directly, with temporary start and end nodes
+        nodes = mesh.nodes
+        start_edges = [(i, point_dist(start, n)) for (i, n) in enumerate(nodes) 
+                       if n != start and not line_intersects_grid(start, n, grid, tilesize)]
+        goal = mesh.node_id(end)
+        if goal is not None:
+            goal_edges = None
+        else:
+            goal = end
+            goal_edges = dict((i, point_dist(end, n)) for (i, n) in enumerate(nodes + (start,))
+                              if not line_intersects_grid(end, n, grid, tilesize))
+        path, length = mesh.astar(start, goal, start_edges, goal_edges)
+        return [(nodes[i] if i < len(nodes) else end) for i in path]
     # Copy mesh so we can add temp nodes
     mesh = copy.deepcopy(mesh)
     # Add temp notes for start
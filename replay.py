@@ -8,26 +8,98 @@ import sys
 import glob
 import os
 import random
+import argparse
+import multiprocessing
 
 import domination
+from domination import scenarios
 
 # This hack seems to be needed to make pickle find the core module
 sys.path.append(os.path.split(__file__)[0])
 
-def run_replay(path, rendered=True):
+def load_replay(path):
     openfile = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
-    g = domination.core.Game(replay=pickle.load(openfile), rendered=rendered).run()
+    return pickle.load(openfile)
+
+def run_replay(path, rendered=True, **kwargs):
+    """ Plays a replay, the keyword arguments are passed to the renderer. 
+        Without rendering, this only computes the stats.
+    """
+    g = domination.core.Game(replay=load_replay(path), rendered=False, verbose=rendered)
+    if rendered:
+        g.add_renderer(**kwargs)
+    g.run()
     print g.stats
 
+def render_replay(path, frames=None, encoder=None, **kwargs):
+    """ Renders a replay offscreen, saving the frames as PNG images
+        and/or sending them to an encoder. Any ``{name}`` in the frames
+        pattern or the encoder command is replaced by the name of the
+        replay file, so that many replays can be rendered at once.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    if frames is not None:
+        frames = frames.replace('{name}', name)
+    if encoder is not None:
+        encoder = encoder.replace('{name}', name)
+    g = domination.core.Game(replay=load_replay(path), rendered=False, verbose=False)
+    g.add_renderer(offscreen=True, frames=frames, encoder=encoder, **kwargs)
+    g.run()
+    return path, g.stats
+
+def _render_replay((path, frames, encoder, kwargs)):
+    return render_replay(path, frames, encoder, **kwargs)
 
 if __name__ == '__main__':
-    if os.path.isdir(sys.argv[1]):
-    	files = glob.glob(os.path.join(sys.argv[1], '*.pickle'))
-    	# random.shuffle(files)
-        for f in files:
-            run_replay(f)
-    else:
-        rendered = '-s' not in sys.argv
-        run_replay(sys.argv[1], rendered)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('paths', nargs='+',
+                        help="Replay files (.pickle or .gz), or folders containing them. "
+                             "With --verify, also replays.zip archives.")
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help="Don't render, only simulate the games and print their stats.")
+    parser.add_argument('--speed', type=int, default=1,
+                        help="Playback speed, from 1 to 64 times real time, by drawing fewer frames. "
+                             "Can be changed with +/- while playing.")
+    parser.add_argument('--step-only', action='store_true',
+                        help="Only draw one frame per step, without animating the movement.")
+    parser.add_argument('--every', type=int, default=1, metavar='K',
+                        help="Only draw every K-th step.")
+    parser.add_argument('--frames', metavar='PATTERN',
+                        help="Render offscreen and save the frames as PNG images, e.g. 'frames/{name}/%%06d.png'.")
+    parser.add_argument('--encoder', metavar='COMMAND',
+                        help="Render offscreen and send raw RGB frames to the standard input of this command, e.g. "
+                             "'ffmpeg -f rawvideo -pix_fmt rgb24 -s {width}x{height} -r {fps} -i - {name}.mp4'.")
+    parser.add_argument('--verify', metavar='CSV',
+                        help="Simulate all replays in parallel without rendering, write their stats to this "
+                             "CSV file, and report the replays whose score doesn't match the stored one. "
+                             "Exits with status 1 if any replay doesn't match.")
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help="Number of replays to render offscreen or verify at the same time (default: number of CPUs).")
+    args = parser.parse_args()
+    options = dict(speed=args.speed, step_only=args.step_only, every=args.every)
 
-    
\ No newline at end of file
+    if args.verify is not None:
+        rows = scenarios.verify_replays(args.paths, output=args.verify, processes=args.processes)
+        failed = sum(1 for r in rows if r['mismatch'] or r['error'])
+        print "Verified %d replays, %d did not match." % (len(rows), failed)
+        # Fail the run, e.g. in CI, if any replay didn't reproduce
+        sys.exit(1 if failed else 0)
+
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.pickle'))))
+        else:
+            files.append(path)
+
+    if args.frames is not None or args.encoder is not None:
+        pool = multiprocessing.Pool(args.processes)
+        jobs = [(f, args.frames, args.encoder, options) for f in files]
+        for path, stats in pool.imap(_render_replay, jobs):
+            print path
+            print stats
+        pool.close()
+        pool.join()
+    else:
+        for f in files:
+            run_replay(f, rendered=not args.stats, **options)